@@ -0,0 +1,15 @@
+# Script to create all analysis outputs (timeseries, regional timeseries,
+# breakdowns and code tables) of blood pressure monitoring codes, loading the
+# cohorts once
+
+import sys
+
+if "." not in sys.path:
+    sys.path.insert(0, ".")
+from analysis.analysis_data_processing.analysis_all import analysis_all
+
+
+homecare_type = "bp"
+codes_of_interest = ["413606001"]
+
+analysis_all(homecare_type, codes_of_interest, incremental=True)
@@ -0,0 +1,238 @@
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List
+import os
+import pandas as pd
+import sys
+
+if "." not in sys.path:
+    sys.path.insert(0, ".")
+from analysis.analysis_data_processing.analysis_data_processing import (
+    analysis_workers,
+    create_headers_dict,
+    homecare_type_dir,
+    load_weekly_file,
+    read_cache_manifest,
+    read_weekly_catalog,
+    source_signature,
+    weekly_filepaths,
+    write_cache_file,
+    write_cache_manifest,
+)
+from analysis.analysis_data_processing.instrumentation import instrumented
+from analysis.analysis_data_processing.patient_sets import dense_patient_ordinals
+from analysis.analysis_data_processing.schema import (
+    apply_breakdown_schema,
+    breakdown_schema,
+    concat_population,
+)
+
+# Version of the weekly aggregates, to be increased whenever the way they are
+# computed changes so that existing aggregates are rebuilt
+aggregate_version = 2
+
+# Partial aggregates kept for each weekly input file
+aggregate_tables = [
+    "code_sums",
+    "region_sums",
+    "patient_code_sums",
+    "breakdown_patients",
+]
+
+
+def weekly_aggregates(df: pd.DataFrame, headers: List[str]) -> Dict:
+    """Function to compute the partial aggregates of a weekly dataframe: the
+    total of each code (code_sums), the total of each code in each region
+    (region_sums), the total of each code for each patient with any code
+    (patient_code_sums) and the distinct patients with any code in each
+    category of every breakdown variable, with a flag of whether they have
+    each code (breakdown_patients). Distinct patient counts only need the
+    patients of each week, so the patient aggregates merge by union and no
+    other column of the weekly file is kept"""
+    code_sums = df.groupby("index_date")[headers].sum().reset_index()
+    region_sums = (
+        df.groupby(["index_date", "region"], observed=True)[headers]
+        .sum()
+        .reset_index()
+    )
+
+    # Keep only the patients with any code
+    df = df.loc[(df[headers] > 0).any(axis=1)]
+    patient_code_sums = (
+        df.groupby(["index_date", "patient_id"], sort=False)[headers]
+        .sum()
+        .reset_index()
+    )
+
+    # Replace the source columns of the breakdown variables with their labels,
+    # and the codes with flags
+    variables = list(breakdown_schema)
+    sources = list(dict.fromkeys(spec["source"] for spec in breakdown_schema.values()))
+    breakdown_patients = apply_breakdown_schema(
+        df[["index_date", "patient_id"] + headers + sources].copy(), variables
+    )
+    breakdown_patients = breakdown_patients.drop(
+        columns=[source for source in sources if source not in variables]
+    )
+    breakdown_patients[headers] = (breakdown_patients[headers] > 0).astype("int8")
+    breakdown_patients = breakdown_patients.drop_duplicates()
+
+    return {
+        "code_sums": code_sums,
+        "region_sums": region_sums,
+        "patient_code_sums": patient_code_sums,
+        "breakdown_patients": breakdown_patients,
+    }
+
+
+def aggregate_filepath(filepath: str, aggregates_dir: str, table: str) -> str:
+    """Function to return the path of a partial aggregate of a weekly input
+    csv file"""
+    filename = os.path.splitext(os.path.basename(filepath))[0]
+    return f"{aggregates_dir}{filename}.{table}.feather"
+
+
+def remove_aggregates(filepath: str, aggregates_dir: str):
+    """Function to remove every partial aggregate of a weekly input csv file,
+    including those of tables which are no longer kept"""
+    prefix = os.path.splitext(os.path.basename(filepath))[0] + "."
+    for filename in os.listdir(aggregates_dir):
+        if filename.startswith(prefix) and filename.endswith(".feather"):
+            os.remove(aggregates_dir + filename)
+
+
+def aggregate_signature(
+    filepath: str, headers: List[str], catalog: Dict = None
+) -> Dict:
+    """Function to return the signature of a weekly input csv file (see
+    source_signature) and the codes its aggregates are computed for, used to
+    decide whether they are still fresh"""
+    signature = source_signature(filepath, catalog)
+    signature["aggregate_version"] = aggregate_version
+    signature["headers"] = headers
+    return signature
+
+
+def update_file_aggregates(
+    filepath: str,
+    aggregates_dir: str,
+    cache_dir: str,
+    cached_signature: Dict,
+    headers: List[str],
+) -> Dict:
+    """Function to load a single weekly input file, compute its aggregates and
+    save them, so that the file's dataframe can be dropped as soon as it is
+    done. Returns the signature of a rebuilt cached copy of the file (or None)"""
+    df, signature = load_weekly_file(filepath, cache_dir, cached_signature)
+    remove_aggregates(filepath, aggregates_dir)
+    for table, aggregate_df in weekly_aggregates(df, headers).items():
+        write_cache_file(
+            aggregate_df, aggregate_filepath(filepath, aggregates_dir, table)
+        )
+    return signature
+
+
+@instrumented
+def update_weekly_aggregates(
+    homecare_type: str,
+    workers: int = None,
+    start_date: str = None,
+    end_date: str = None,
+) -> Dict:
+    """Function to bring the partial aggregates of each weekly input file (or
+    of those with index dates from start_date to end_date, if given) up to
+    date, computing them only for new or changed files, and merge them. Returns
+    a dictionary of each aggregate (see weekly_aggregates) over those weeks,
+    with the renamed headers (i.e. code terms)"""
+    dirs = homecare_type_dir(homecare_type)
+    aggregates_dir = dirs["aggregates_dir"]
+    os.makedirs(aggregates_dir, exist_ok=True)
+    manifest = read_cache_manifest(aggregates_dir)
+    manifest_changed = False
+
+    headers_dict = create_headers_dict(homecare_type)
+    headers = list(headers_dict)
+    all_filepaths = weekly_filepaths(homecare_type, dirs["input_dir"])
+    filepaths = weekly_filepaths(
+        homecare_type, dirs["input_dir"], start_date, end_date
+    )
+
+    # Find the files which are new or have changed since their aggregates were
+    # computed
+    catalog = read_weekly_catalog(dirs["input_dir"])
+    signatures = {
+        file: aggregate_signature(file, headers, catalog) for file in filepaths
+    }
+    stale_filepaths = [
+        file
+        for file in filepaths
+        if manifest.get(os.path.basename(file)) != signatures[file]
+        or not all(
+            os.path.exists(aggregate_filepath(file, aggregates_dir, table))
+            for table in aggregate_tables
+        )
+    ]
+
+    # Compute and save the aggregates of those files only, one file at a time
+    # (or one per worker), so that only those files' rows are held in memory
+    if workers is None:
+        workers = analysis_workers()
+    cache_dir = dirs["cache_dir"]
+    os.makedirs(cache_dir, exist_ok=True)
+    cache_manifest = read_cache_manifest(cache_dir)
+    update_args = (
+        stale_filepaths,
+        [aggregates_dir] * len(stale_filepaths),
+        [cache_dir] * len(stale_filepaths),
+        [cache_manifest.get(os.path.basename(file)) for file in stale_filepaths],
+        [headers] * len(stale_filepaths),
+    )
+    if workers > 1 and len(stale_filepaths) > 1:
+        # As in load_weekly_files, the first file is done before the pool starts
+        cache_signatures = [update_file_aggregates(*[arg[0] for arg in update_args])]
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            cache_signatures += list(
+                pool.map(update_file_aggregates, *[arg[1:] for arg in update_args])
+            )
+    else:
+        cache_signatures = list(map(update_file_aggregates, *update_args))
+
+    cache_manifest_changed = False
+    for file, cache_signature in zip(stale_filepaths, cache_signatures):
+        manifest[os.path.basename(file)] = signatures[file]
+        manifest_changed = True
+        # Record any weeks whose cached copy was rebuilt on the way
+        if cache_signature is not None:
+            cache_manifest[os.path.basename(file)] = cache_signature
+            cache_manifest_changed = True
+    if cache_manifest_changed:
+        write_cache_manifest(cache_dir, cache_manifest)
+
+    # Remove the aggregates of input files which no longer exist
+    current_files = {os.path.basename(file) for file in all_filepaths}
+    for filename in list(manifest):
+        if filename not in current_files:
+            remove_aggregates(filename, aggregates_dir)
+            del manifest[filename]
+            manifest_changed = True
+
+    if manifest_changed:
+        write_cache_manifest(aggregates_dir, manifest)
+
+    # Merge the aggregates of all weeks
+    aggregates = {}
+    for table in aggregate_tables:
+        aggregates[table] = concat_population(
+            [
+                pd.read_feather(aggregate_filepath(file, aggregates_dir, table))
+                for file in filepaths
+            ]
+        )
+        aggregates[table].rename(columns=headers_dict, inplace=True)
+
+    # Number the patients once, for distinct patient counts
+    for table in ["patient_code_sums", "breakdown_patients"]:
+        aggregates[table]["patient_ordinal"] = dense_patient_ordinals(
+            aggregates[table]["patient_id"]
+        )
+
+    return aggregates
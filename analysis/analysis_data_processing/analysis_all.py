@@ -0,0 +1,115 @@
+import sys
+
+if "." not in sys.path:
+    sys.path.insert(0, ".")
+from analysis.analysis_data_processing.aggregates import update_weekly_aggregates
+from analysis.analysis_data_processing.analysis_breakdowns import (
+    analysis_breakdowns,
+    analysis_region,
+    analysis_timeseries,
+)
+from analysis.analysis_data_processing.analysis_data_processing import (
+    create_population_df,
+    homecare_type_dir,
+    weekly_filepaths,
+    weekly_input_rows,
+)
+from analysis.analysis_data_processing.codes_summary import code_analysis
+from analysis.analysis_data_processing.instrumentation import (
+    reset_stage_records,
+    stage,
+    write_run_report,
+)
+from analysis.analysis_data_processing.output_writer import output_writer
+from analysis.analysis_data_processing.rollups import analysis_resolution
+
+
+def analysis_all(
+    homecare_type: str,
+    codes_of_interest: list,
+    defer_plots: bool = False,
+    incremental: bool = False,
+    start_date: str = None,
+    end_date: str = None,
+    resolution: str = None,
+):
+    """Function to run the timeseries, region, breakdowns and codes analyses
+    for a homecare type, loading the population dataframe only once. With
+    defer_plots only the tables and plot manifests are saved, and the plots
+    can be rendered later by render_plot_manifests. With incremental the
+    analyses use the partial aggregates of each week (totals and sets of
+    patients), which are only computed for weeks that are new or have changed
+    since the last run. If start_date or end_date is given, only the weeks
+    with index dates in that window are analysed. The tables and plots are
+    rolled up from weekly totals and sets of patients to the given resolution
+    (by default set by analysis_resolution), i.e. "W", "M" or "Q". Output
+    files are written by a background output writer, which saves a manifest
+    of them"""
+
+    dirs = homecare_type_dir(homecare_type)
+
+    if resolution is None:
+        resolution = analysis_resolution()
+
+    # Measure each stage of this run (see instrumentation.py), profiling the
+    # stages within rather than the whole run
+    reset_stage_records()
+
+    # Write the tables and plots on background threads while the analyses run
+    # (see output_writer.py), saving a manifest of every file written
+    output_manifest = dirs["output_dir"] + homecare_type + "_output_manifest.json"
+
+    with stage("analysis_all", profile=False) as measurement, output_writer(
+        output_manifest
+    ):
+        # Record the number of input rows analysed, from the catalog
+        measurement["input_rows"] = weekly_input_rows(
+            weekly_filepaths(homecare_type, dirs["input_dir"], start_date, end_date),
+            dirs["input_dir"],
+        )
+        if incremental:
+            # Merge the aggregates of each week, updating those that are stale
+            aggregates = update_weekly_aggregates(
+                homecare_type, start_date=start_date, end_date=end_date
+            )
+            code_sums = aggregates["code_sums"]
+            region_sums = aggregates["region_sums"]
+            population_df = aggregates["patient_code_sums"]
+            breakdown_df = aggregates["breakdown_patients"]
+        else:
+            # Create population data frame which includes all weeks, shared by
+            # all of the analyses below
+            population_df = create_population_df(
+                homecare_type,
+                dirs["input_dir"],
+                start_date=start_date,
+                end_date=end_date,
+            )
+            code_sums = region_sums = breakdown_df = population_df
+
+        analysis_timeseries(
+            homecare_type, code_sums, defer_plots=defer_plots, resolution=resolution
+        )
+
+        analysis_region(
+            homecare_type, region_sums, defer_plots=defer_plots, resolution=resolution
+        )
+
+        analysis_breakdowns(
+            homecare_type,
+            codes_of_interest,
+            breakdown_df,
+            defer_plots=defer_plots,
+            resolution=resolution,
+            labelled=incremental,
+        )
+
+        code_analysis(homecare_type, population_df)
+
+    # Save the measurements and report the time taken by each stage
+    report = write_run_report(homecare_type, dirs["output_dir"])
+    for name, record in report["stages"].items():
+        print(
+            f"{homecare_type} {name}: {record['wall_seconds']:.1f}s"
+            f" ({record['calls']} calls)"
+        )
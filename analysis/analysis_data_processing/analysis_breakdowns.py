@@ -1,4 +1,6 @@
-from os import strerror
+from concurrent.futures import ProcessPoolExecutor
+import os
+from typing import Dict, List, Tuple
 import numpy as np
 import pandas as pd
 import sys
@@ -6,23 +8,131 @@ import sys
 if "." not in sys.path:
     sys.path.insert(0, ".")
 from analysis.analysis_data_processing.analysis_data_processing import (
+    analysis_workers,
     create_headers_dict,
     create_population_df,
-    homecare_type_dir
+    homecare_type_dir,
+    weekly_sums,
+)
+from analysis.analysis_data_processing.instrumentation import (
+    call_with_stage_records,
+    instrumented,
+    merge_stage_records,
+)
+from analysis.analysis_data_processing.output_writer import (
+    flush_output,
+    record_output,
+    write_table,
+)
+from analysis.analysis_data_processing.patient_sets import (
+    distinct_counts,
+    patient_ordinals,
 )
 from analysis.analysis_data_processing.plot import *
 from analysis.analysis_data_processing.redaction import *
+from analysis.analysis_data_processing.rollups import (
+    analysis_resolution,
+    period_index,
+    resolution_suffix,
+    roll_up,
+)
+from analysis.analysis_data_processing.schema import (
+    apply_breakdown_schema,
+    breakdown_schema,
+    geography_titles,
+)
 
 
 def add_age_category(population_df: pd.DataFrame) -> pd.DataFrame:
     """Function to add age_group column to dataframe"""
+    return apply_breakdown_schema(population_df, ["age_group"])
 
-    population_df.loc[population_df["age"] <= 39, "age_group"] = "Age 0-39"
-    population_df.loc[population_df["age"].between(40, 49), "age_group"] = "Age 40-49"
-    population_df.loc[population_df["age"].between(50, 64), "age_group"] = "Age 50-64"
-    population_df.loc[population_df["age"] >= 65, "age_group"] = "Age 65 or over"
 
-    return population_df
+@instrumented
+def breakdown_cube(
+    population_df: pd.DataFrame,
+    terms: list,
+    variables: list,
+    resolution: str = None,
+) -> Tuple[pd.DataFrame, Dict]:
+    """Function to count the number of distinct patients with each code (term)
+    in each category of each variable for each period of the resolution (by
+    default set by analysis_resolution). The patients of the weeks in each
+    period are collected into one patient bitmap for each term and category,
+    i.e. the union of the weeks, and counted a block of bitmaps at a time.
+    Returns the cube, with columns term, variable, index_date, category and
+    counts, and a dictionary of the labels of each variable's category codes"""
+
+    if resolution is None:
+        resolution = analysis_resolution()
+
+    # Number the periods which the weeks roll up to and the patients once for
+    # all codes and variables
+    period_codes, periods = pd.factorize(
+        period_index(population_df["index_date"], resolution), sort=True
+    )
+    n_periods = len(periods)
+    ordinals, n_patients = patient_ordinals(population_df)
+
+    # The rows with each code, as (row, term) pairs for all the terms at once
+    code_rows, code_terms = np.nonzero(population_df[terms].to_numpy() > 0)
+
+    cube = []
+    labels = {}
+    for variable in variables:
+        # Encode the categories as integers (-1 if missing), in the same order
+        # as a groupby on the variable would sort them, and number each
+        # (period, category) once for all the terms
+        category_codes, labels[variable] = pd.factorize(
+            population_df[variable], sort=True
+        )
+        n_categories = len(labels[variable])
+        period_categories = period_codes * n_categories + category_codes
+
+        # Count the patients with each code in each period and category in one
+        # pass. The code and the category must be on the same weekly row, as a
+        # patient's category can change between the weeks of a period, so the
+        # groups are taken from the rows rather than by intersecting a bitmap
+        # per term with a bitmap per category
+        keep = category_codes[code_rows] >= 0
+        rows = code_rows[keep]
+        groups = code_terms[keep] * (n_periods * n_categories) + period_categories[rows]
+        counts = distinct_counts(
+            ordinals[rows], groups, len(terms) * n_periods * n_categories, n_patients
+        )
+
+        # Keep the groups with any patients, as a groupby would
+        present = np.flatnonzero(counts)
+        term_groups, period_category = np.divmod(present, n_periods * n_categories)
+        cube.append(
+            pd.DataFrame(
+                {
+                    "term": np.asarray(terms, dtype=object)[term_groups],
+                    "variable": variable,
+                    "index_date": periods.take(period_category // n_categories),
+                    "category": period_category % n_categories,
+                    "counts": counts[present],
+                }
+            )
+        )
+    cube = pd.concat(cube, ignore_index=True)
+
+    return cube, labels
+
+
+def cube_summary(
+    cube: pd.DataFrame, labels: Dict, term: str, variable: str
+) -> pd.DataFrame:
+    """Function to extract the counts of patients with a code in each category
+    of a variable for each period from the breakdown cube"""
+    summary_df = cube.loc[
+        (cube["term"] == term) & (cube["variable"] == variable),
+        ["index_date", "category", "counts"],
+    ]
+    # Replace the category codes with their labels
+    summary_df = summary_df.rename(columns={"category": variable})
+    summary_df[variable] = labels[variable].take(summary_df[variable].to_numpy())
+    return summary_df.reset_index(drop=True)
 
 
 def code_time_analysis(
@@ -31,23 +141,48 @@ def code_time_analysis(
     variable: str,
     variable_title,
     population_df: pd.DataFrame,
+    resolution: str = None,
 ):
     """Function to take a SNOMED code and save the timeseries and
     its underlying table, grouped by a specific column"""
 
+    if resolution is None:
+        resolution = analysis_resolution()
+
+    # Count the number of patients in each group for each index date
+    cube, labels = breakdown_cube(population_df, [term], [variable], resolution)
+    summary_df = cube_summary(cube, labels, term, variable)
+
+    breakdown_table(
+        homecare_type, term, variable, variable_title, summary_df, resolution=resolution
+    )
+
+
+@instrumented
+def breakdown_table(
+    homecare_type: str,
+    term: str,
+    variable: str,
+    variable_title,
+    summary_df: pd.DataFrame,
+    render: bool = True,
+    resolution: str = None,
+) -> Dict:
+    """Function to take the counts of patients with a SNOMED code in each group
+    of a specific column for each period of the resolution (by default set by
+    analysis_resolution), and save the timeseries (unless render is False) and
+    its underlying table. Returns the plot's spec"""
+
     dirs = homecare_type_dir(homecare_type)
 
-    # Population of interest is all patients with the code
-    codes_df = population_df.loc[population_df[term] > 0]
+    if resolution is None:
+        resolution = analysis_resolution()
 
-    # Count the number of patients in each group for each index date
-    summary_df = (
-        codes_df.groupby([codes_df['index_date'].dt.to_period('M'), variable])["patient_id"].nunique().reset_index()
+    # Add in missing index dates where necessary. Create full date range,
+    # including the last period
+    all_dates = pd.period_range(
+        summary_df["index_date"].min(), summary_df["index_date"].max(), freq=resolution
     )
-    summary_df.rename(columns={"patient_id": "counts"}, inplace=True)
-    
-    # Add in missing index dates where necessary. Create full date range
-    all_dates = (pd.date_range(start=summary_df['index_date'].min().to_timestamp(),end=summary_df['index_date'].max().to_timestamp(), freq='M')).to_period('M')
 
     # Create dataframe of all possible combinations of date-terms
     complete_df = pd.merge(pd.DataFrame({'index_date':all_dates, 'key':0}),
@@ -68,227 +203,393 @@ def code_time_analysis(
         1,)
 
     # Save the dataframe in outputs folder
-    summary_df.to_csv(
-        f"""{dirs["output_dir"]}{homecare_type}_table_{term}_{variable}_counts.csv"""
-    )
+    suffix = resolution_suffix(resolution)
+    table = f"""{dirs["output_dir"]}{homecare_type}_table_{term}_{variable}_counts{suffix}.csv"""
+    write_table(summary_df, table)
 
     # Produce the required timeseries
-    produce_pivot_plot(
+    job = pivot_plot_job(
         homecare_type,
         summary_df,
         term,
         variable,
         variable_title,
         "percentage",
+        table,
+        resolution,
     )
+    if render:
+        render_plot(job)
+
+    return plot_spec(job)
 
 
-def analysis_breakdowns(homecare_type: str, codes_of_interest: list):
+# Breakdown cube and labels of the process which started a pool of breakdown
+# workers, set once in each worker rather than sent with every job
+_breakdown_worker_data = {}
+
+
+def init_breakdown_worker(cube: pd.DataFrame, labels: Dict):
+    """Function to set up a process pool worker for breakdown jobs"""
+    _breakdown_worker_data["cube"] = cube
+    _breakdown_worker_data["labels"] = labels
+
+
+def breakdown_job(
+    homecare_type: str,
+    term: str,
+    variable: str,
+    variable_title,
+    render: bool,
+    resolution: str,
+) -> Dict:
+    """Function to save the table and plot of a code broken down by a variable,
+    in a process pool worker"""
+    summary_df = cube_summary(
+        _breakdown_worker_data["cube"],
+        _breakdown_worker_data["labels"],
+        term,
+        variable,
+    )
+    return breakdown_table(
+        homecare_type, term, variable, variable_title, summary_df, render, resolution
+    )
+
+
+@instrumented
+def analysis_breakdowns(
+    homecare_type: str,
+    codes_of_interest: list,
+    population_df: pd.DataFrame = None,
+    workers: int = None,
+    defer_plots: bool = False,
+    resolution: str = None,
+    labelled: bool = False,
+) -> List[Dict]:
     """Function to run analysis of timeseries broken down by
     age category, shielding status, sex, IMD decile, ethnicity,
     care home residency and age_plus_shielding_status
-    for codes of interest"""
+    for codes of interest, at the given resolution (by default set by
+    analysis_resolution). Uses population_df if given, otherwise loads it.
+    If labelled, population_df has the labelled variables rather than their
+    source columns (i.e. the breakdown patients of update_weekly_aggregates).
+    With more than one worker (by default set by analysis_workers) the tables
+    and plots are produced in a process pool. The plots are saved to a plot
+    manifest, and only rendered now unless defer_plots. Returns their specs"""
 
     dirs = homecare_type_dir(homecare_type)
     headers_dict = create_headers_dict(homecare_type)
 
-    # Create population data frame which includes all weeks and dictionary of
-    population_df = create_population_df(homecare_type, dirs["input_dir"])
+    if resolution is None:
+        resolution = analysis_resolution()
 
-    # Add age category column to population dataframe
-    population_df = add_age_category(population_df)
-
-    # Populate cells with missing ethnicity
-    population_df["ethnicity"].fillna("Missing", inplace=True)
+    # Variables of interest (see breakdown_schema) and corresponding plot titles
+    variable_and_title = {
+        variable: spec["title"] for variable, spec in breakdown_schema.items()
+    }
 
-    # Replace binary flags and abbreviations with meaningful values
-    population_df = population_df.replace(
-        {"sex": {"M": "Male", "F": "Female", "I": "Intersex", "U": "Unknown"}}
-    )
-    population_df = population_df.replace(
-        {"care_home": {0: "Not a care home resident", 1: "Care home resident"}}
-    )
-    population_df = population_df.replace(
-        {"shielding": {0: "Not Shielding", 1: "Shielding"}}
-    )
-    population_df = population_df.replace(
-        {
-            "has_hypertension_code": {
-                0: "Does not have hypertension",
-                1: "Has hypertension",
-            }
-        }
+    # Terms of the codes of interest
+    terms = [
+        headers_dict[f"healthcare_at_home_{code}"] for code in codes_of_interest
+    ]
+
+    # Create population data frame which includes all weeks, loading only the
+    # codes of interest and the columns the variables are derived from
+    sources = list(dict.fromkeys(spec["source"] for spec in breakdown_schema.values()))
+    if labelled:
+        columns = ["patient_id"] + terms + list(variable_and_title)
+    else:
+        columns = ["patient_id"] + terms + sources
+    if population_df is None:
+        population_df = create_population_df(
+            homecare_type, dirs["input_dir"], columns=columns
+        )
+    # Otherwise take a copy of these columns, as the labelling below would
+    # change the shared dataframe
+    else:
+        if "patient_ordinal" in population_df.columns:
+            columns = columns + ["patient_ordinal"]
+        population_df = population_df[columns + ["index_date"]].copy()
+
+    # Replace the source columns with the labelled variables of interest
+    if not labelled:
+        population_df = apply_breakdown_schema(
+            population_df, list(variable_and_title)
+        )
+
+    # Count the patients with each code in each group for each period, for all
+    # codes and variables of interest at once
+    cube, labels = breakdown_cube(
+        population_df, terms, list(variable_and_title), resolution
     )
-    population_df = population_df.replace(
-        {
-            "has_diabetes_type_2_code": {
-                0: "Does not have type 2 diabetes",
-                1: "Has type 2 diabetes",
-            }
-        }
-    )
-    population_df = population_df.replace(
-        {"has_asthma_code": {0: "Does not have asthma", 1: "Has asthma"}}
-    )
-    population_df = population_df.replace(
-        {"has_copd_code": {0: "Does not have COPD", 1: "Has COPD"}}
-    )
-    population_df = population_df.replace(
-        {
-            "has_atrial_fibrillation_code": {
-                0: "Does not have atrial fibrillation",
-                1: "Has atrial fibrillation",
-            }
-        }
-    )
-    population_df = population_df.replace(
-        {
-            "imd_quintile": {
-                1: "1",
-                2: "2",
-                3: "3",
-                4: "4",
-                5: "5",
-            }
-        }
-    )
-    # Labels for ethnicity groupings are as stated in "About" section
-    # of codelist
-    # https://www.opencodelists.org/codelist/opensafely/ethnicity-snomed-0removed/2e641f61/
-    population_df = population_df.replace(
-        {
-            "ethnicity": {
-                "1": "White",
-                "2": "Mixed",
-                "3": "Asian or Asian British",
-                "4": "Black or Black British",
-                "5": "Chinese or Other Ethnic Groups",
-            }
-        }
+
+    # Create timeseries for the codes broken down by the variables of interest
+    jobs = [
+        (term, variable, title)
+        for term in terms
+        for variable, title in variable_and_title.items()
+    ]
+    if workers is None:
+        workers = analysis_workers()
+    if workers > 1 and len(jobs) > 1:
+        # Finish any queued writes before the workers are forked
+        flush_output()
+        # The cube is passed to each worker once, when the worker starts
+        with ProcessPoolExecutor(
+            max_workers=workers,
+            initializer=init_breakdown_worker,
+            initargs=(cube, labels),
+        ) as pool:
+            futures = [
+                pool.submit(
+                    call_with_stage_records,
+                    breakdown_job,
+                    homecare_type,
+                    *job,
+                    not defer_plots,
+                    resolution,
+                )
+                for job in jobs
+            ]
+            # Raise any error from the workers, and add the measurements of
+            # the stages they ran to those of this process
+            specs = []
+            for future in futures:
+                spec, records = future.result()
+                specs.append(spec)
+                merge_stage_records(records)
+        # Add the files saved by the workers to the manifest of any output
+        # writer
+        for spec in specs:
+            record_output(spec["table"], "table")
+            if not defer_plots and os.path.exists(png_filepath(spec["filepath"])):
+                record_output(png_filepath(spec["filepath"]), "plot")
+    else:
+        specs = []
+        for term, variable, title in jobs:
+            summary_df = cube_summary(cube, labels, term, variable)
+            specs.append(
+                breakdown_table(
+                    homecare_type,
+                    term,
+                    variable,
+                    title,
+                    summary_df,
+                    not defer_plots,
+                    resolution,
+                )
+            )
+
+    # Save the description of the plots, so they can be rendered again
+    write_plot_manifest(
+        homecare_type, "breakdowns" + resolution_suffix(resolution), specs
     )
 
-    # Define variables of interest and corresponding plot titles
-    variable_and_title = {
-        "sex": "sex",
-        "care_home": "care home residency",
-        "shielding": "shielding status",
-        "age_group": "age",
-        "ethnicity": "ethnicity",
-        "imd_quintile": "IMD quintile (1 = most deprived, 5 = least deprived)",
-        "has_hypertension_code": "whether patient has hypertension",
-        "has_diabetes_type_2_code": "whether patient has type 2 diabetes",
-        "has_asthma_code": "whether patient has asthma",
-        "has_copd_code": "whether patient has COPD",
-        "has_atrial_fibrillation_code": "whether patient has atrial fibrillation",
-    }
+    return specs
 
-    # Create timeseries for the codes broken down by the variables of interest
-    for code in codes_of_interest:
-        term = headers_dict[f"healthcare_at_home_{code}"]
-        for variable, title in variable_and_title.items():
-            code_time_analysis(homecare_type, term, variable, title, population_df)
 
+def geography_sums(
+    population_df: pd.DataFrame,
+    geography: str,
+    headers: List[str],
+    resolution: str = "M",
+) -> pd.DataFrame:
+    """Function to roll up the totals of each code to each period of the
+    resolution in each area of a geography (i.e. each region), over the
+    complete grid of periods and areas so that an area without any use of the
+    codes in a period has totals of 0 rather than being left out (to avoid
+    disclosure by group). Rows are in order of period, then area"""
+    periods = period_index(population_df["index_date"], resolution)
+    sums = population_df.groupby([periods, geography], observed=True)[headers].sum()
+
+    # Add in any period-area combinations that are missing
+    grid = pd.MultiIndex.from_product(
+        [
+            sorted(periods.unique()),
+            sorted(population_df[geography].dropna().unique(), key=str),
+        ],
+        names=["index_date", geography],
+    )
+    return sums.reindex(grid, fill_value=0).reset_index()
 
-def analysis_region(homecare_type: str):
-    """Function to produce timeseries plots for each region"""
 
-    dirs = homecare_type_dir(homecare_type)
+def area_filename(geography: str, area) -> str:
+    """Function to return the part of output filenames naming an area of a
+    geography, which for regions is the name of the region alone"""
+    if geography == "region":
+        return str(area)
+    return f"{geography}_{area}"
 
-    headers_dict = create_headers_dict(homecare_type)
 
-    # Create population data frame which includes all weeks and dictionary of
-    # cohort size for each individual week
-    population_df = create_population_df(homecare_type, dirs["input_dir"])
+@instrumented
+def analysis_region(
+    homecare_type: str,
+    population_df: pd.DataFrame = None,
+    workers: int = None,
+    defer_plots: bool = False,
+    geography: str = "region",
+    resolution: str = None,
+) -> List[Dict]:
+    """Function to produce timeseries plots for each area of a geography (by
+    default each region) at the given resolution (by default set by
+    analysis_resolution). Uses population_df if given (which may also be the
+    weekly totals of each code in each region, see update_weekly_aggregates),
+    otherwise streams the weekly totals from the weekly files. The tables of
+    each area are split from the table of all areas in one pass and saved, and
+    the plots are rendered by render_plots, with the given number of workers
+    (by default set by analysis_workers). Plots are not rendered if
+    defer_plots, but are saved to a plot manifest. Returns their specs"""
 
-    # Create list of regions in the data
-    region_list = population_df["region"].unique()
+    dirs = homecare_type_dir(homecare_type)
 
-    # Create list of indexes in data
-    index_list = population_df["index_date"].dt.to_period('M').unique()
+    headers_dict = create_headers_dict(homecare_type)
+    headers = list(headers_dict.values())
 
-    # Create multiindex from the product regions and index_dates
-    s = pd.MultiIndex.from_product([region_list,index_list])
+    if workers is None:
+        workers = analysis_workers()
+    if resolution is None:
+        resolution = analysis_resolution()
+    suffix = resolution_suffix(resolution)
 
-    # Create data frame of sum totals for each index date for each oximetry code
-    sum_regions = population_df.groupby([population_df['index_date'].dt.to_period('M'), "region"], as_index=True)[
-        list(headers_dict.values())
-    ].sum().reset_index()
+    # Without a population dataframe, stream the totals of each code in each
+    # area for each week from the weekly files
+    if population_df is None:
+        population_df = weekly_sums(homecare_type, dirs["input_dir"], by=[geography])
 
-    # Add add in any index_date-region combination that are missing (to avoid disclosure by group)
-    sum_regions.set_index(['region', 'index_date']).reindex(s).reset_index().rename({
-        'level_0':'region','level_1':'index_date'},axis=1).fillna({k:0 for k in sum_regions.columns.drop(['index_date','region'])}, inplace=True)
+    # Create data frame of sum totals for each period in each area
+    sum_areas = geography_sums(population_df, geography, headers, resolution)
 
-    # Apply redaction to entire data frame
-    for header in list(headers_dict.values()):
-        sum_regions = redact_to_five_and_round(sum_regions, header)
+    # Apply redaction to all the codes at once
+    sum_areas = redact_to_five_and_round(sum_areas, headers)
 
     # Save the dataframe
-    sum_regions.to_csv(
-        dirs["output_dir"] + homecare_type + "_table_counts_allregions.csv"
+    table = (
+        f"{dirs['output_dir']}{homecare_type}_table_counts_all{geography}s{suffix}.csv"
     )
+    write_table(sum_areas, table)
+
+    # Split the rows of each area from the table in one pass
+    area_dfs = dict(list(sum_areas.groupby(geography, observed=True, sort=False)))
+
+    # Save the dataframe of each area in outputs folder
+    for area, area_df in area_dfs.items():
+        write_table(
+            area_df,
+            f"{dirs['output_dir']}{homecare_type}_table_counts_"
+            f"{area_filename(geography, area)}{suffix}.csv",
+        )
 
     # Define homecare title for plot
     title = homecare_title(homecare_type)
+    geography_title = geography_titles.get(geography, geography)
 
-    # For each region
-    for region in region_list:
-        # Extract all rows for that region
-        region_df = sum_regions.loc[sum_regions["region"] == region]
-        # Save the dataframe in outputs folder
-        region_df.to_csv("output/" + homecare_type + "_table_counts_" + region + ".csv")
-        # Create timeseries of codes usage
-        region_df.set_index("index_date", inplace=True)
-        try:
-            produce_plot(
-                region_df,
-                "Use of " + title + " Over Time in " + region + " Region",
-                "Date",
-            )
-            plt.savefig(
-                dirs["output_dir"]
-                + homecare_type
-                + "_plot_timeseries_region_"
-                + region,
-                bbox_inches="tight",
-            )
-        except:
-            pass
+    # Create timeseries of codes usage in each area, skipping any area with
+    # nothing to plot
+    plot_jobs = [
+        {
+            "df": area_df.set_index("index_date"),
+            "title": f"Use of {title} Over Time in {area} {geography_title}",
+            "x_label": "Date",
+            "table": table,
+            "filter": {geography: str(area)},
+            "index": "index_date",
+            "index_freq": resolution,
+            "series": headers,
+            "filepath": dirs["output_dir"]
+            + f"{homecare_type}_plot_timeseries_{geography}_{area}{suffix}",
+            "ignore_errors": True,
+        }
+        for area, area_df in area_dfs.items()
+    ]
+    if not defer_plots:
+        render_plots(plot_jobs, workers)
+
+    # Save the description of the plots, so they can be rendered again
+    write_plot_manifest(homecare_type, geography + suffix, plot_jobs)
+
+    return [plot_spec(job) for job in plot_jobs]
 
 
-def analysis_timeseries(homecare_type: str):
-    """Function to produce timeseries plot"""
+@instrumented
+def analysis_timeseries(
+    homecare_type: str,
+    population_df: pd.DataFrame = None,
+    workers: int = None,
+    defer_plots: bool = False,
+    resolution: str = None,
+) -> List[Dict]:
+    """Function to produce timeseries plot at the given resolution (by default
+    set by analysis_resolution). Uses population_df if given (which may also
+    be the weekly totals of each code, see update_weekly_aggregates),
+    otherwise streams the weekly totals from the weekly files. Plots are
+    rendered by render_plots with the given number of workers (by default set
+    by analysis_workers), unless defer_plots, and saved to a plot manifest.
+    Returns their specs"""
 
     dirs = homecare_type_dir(homecare_type)
 
     headers_dict = create_headers_dict(homecare_type)
 
-    # Create population dataframe which includes all weeks and dictionary of
-    # cohort size for each individual week
-    population_df = create_population_df(homecare_type, dirs["input_dir"])
+    if resolution is None:
+        resolution = analysis_resolution()
+    suffix = resolution_suffix(resolution)
+
+    # Without a population dataframe, stream the totals of each code for each
+    # week from the weekly files
+    if population_df is None:
+        population_df = weekly_sums(homecare_type, dirs["input_dir"])
 
-    # Create dataframe of sum totals for each index date
-    sum_df = population_df.groupby(population_df['index_date'].dt.to_period('M'), as_index=True)[
-        list(headers_dict.values())
-    ].sum().reset_index()
+    # Create dataframe of sum totals for each period, rolled up from the weeks
+    sum_df = roll_up(population_df, resolution, list(headers_dict.values()))
 
     # Redact values less than or equal to 5 and round all other values up to
     # nearest 5
     sum_df = redact_and_round_df(sum_df)
 
     # Save the dataframe in outputs folders
-    sum_df.to_csv(dirs["output_dir"] + homecare_type + "_table_counts.csv")
+    table = dirs["output_dir"] + homecare_type + "_table_counts" + suffix + ".csv"
+    write_table(sum_df, table)
 
     # Create timeseries of codes usage
     title = homecare_title(homecare_type)
     sum_df.set_index("index_date", inplace=True)
-    produce_plot(sum_df, "Use of " + title + " Over Time", "Date")
-    plt.savefig(
-        dirs["output_dir"] + homecare_type + "_plot_timeseries", bbox_inches="tight"
-    )
+    plot_jobs = [
+        {
+            "df": sum_df,
+            "title": "Use of " + title + " Over Time",
+            "x_label": "Date",
+            "table": table,
+            "index": "index_date",
+            "index_freq": resolution,
+            "series": list(headers_dict.values()),
+            "filepath": dirs["output_dir"]
+            + homecare_type
+            + "_plot_timeseries"
+            + suffix,
+        }
+    ]
 
     # Create timeseries seperately for each code type:
     for key, value in headers_dict.items():
-        produce_plot(sum_df[value], "Timeseries showing use of "+value)
-        plt.savefig(
-            dirs["output_dir"] + homecare_type + "_plot_timeseries_" + key, bbox_inches="tight"
-        ) 
\ No newline at end of file
+        plot_jobs.append(
+            {
+                "df": sum_df[value],
+                "title": "Timeseries showing use of " + value,
+                "table": table,
+                "index": "index_date",
+                "index_freq": resolution,
+                "series": [value],
+                "filepath": dirs["output_dir"]
+                + homecare_type
+                + "_plot_timeseries_"
+                + key
+                + suffix,
+            }
+        )
+    if not defer_plots:
+        render_plots(plot_jobs, analysis_workers() if workers is None else workers)
+
+    # Save the description of the plots, so they can be rendered again
+    write_plot_manifest(homecare_type, "timeseries" + suffix, plot_jobs)
+
+    return [plot_spec(job) for job in plot_jobs] 
\ No newline at end of file
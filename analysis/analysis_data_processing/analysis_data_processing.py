@@ -1,73 +1,533 @@
-from typing import Dict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Dict, Iterator, List, Tuple
 import pandas as pd
+import pyarrow as pa
+import pyarrow.ipc as ipc
+import hashlib
+import json
 import os
-import math
-import numpy as np
-import matplotlib.pyplot as plt
-from textwrap import wrap
 import sys
 
 if "." not in sys.path:
     sys.path.insert(0, ".")
 from analysis.analysis_data_processing.redaction import *
-from analysis.codelist import oximetry_codes_dict, bp_codes_dict, proactive_codes_dict
+from analysis.analysis_data_processing.instrumentation import instrumented
+from analysis.analysis_data_processing.output_writer import flush_output
+from analysis.analysis_data_processing.patient_sets import dense_patient_ordinals
+from analysis.analysis_data_processing.schema import (
+    apply_population_categories,
+    concat_population,
+    derive_population_flags,
+    population_dtypes,
+    population_source_columns,
+)
+from analysis import codelist
 
 
 def create_headers_dict(homecare_type: str) -> Dict:
     """Function to create header dictionary for the given homecare type,
     whose keys are the headers in input csv files (i.e. healthcare_at_home_code)
     and values are the terms they refer to"""
-    # Find correct codes dictionary
+    # Find correct codes dictionary (loaded by the codelist registry on first use)
     codes_dict_name = f"{homecare_type}_codes_dict"
-    codes_dict = globals()[codes_dict_name]
+    codes_dict = getattr(codelist, codes_dict_name)
     # Convert codes to headers used in population dataframe
     headers_dict = {f"healthcare_at_home_{k}": v for k, v in codes_dict.items()}
     return headers_dict
 
 
-def create_population_df(homecare_type: str, dir: str) -> pd.DataFrame:
-    """Function to create population data frame for a particular homecare type
-    which includes all weeks and create a dictionary of cohort size for each
-    individual week"""
+def index_date_from_filename(filepath: str) -> pd.Timestamp:
+    """Function to extract the index date from the name of a weekly input
+    file (i.e. input_oximetry_2020-01-06.csv)"""
+    filename = os.path.splitext(os.path.basename(filepath))[0]
+    return pd.to_datetime(filename.split("_")[-1], dayfirst=True)
+
+
+def weekly_filepaths(
+    homecare_type: str, dir: str, start_date: str = None, end_date: str = None
+) -> List[str]:
+    """Function to return the paths of the weekly input csv files for a
+    particular homecare type, in index date order. If start_date or end_date
+    is given, only the files with index dates in that (inclusive) window are
+    returned. Index dates are taken from the catalog of the files where it is
+    fresh, otherwise from the filenames"""
     # find the input csv files
     filepaths = [
-        f
+        dir + f
         for f in os.listdir(dir)
         if (f.startswith(f"input_{homecare_type}") and f.endswith(".csv"))
     ]
-    # append the directory path to filename
-    filepaths_dir = [dir + filepath for filepath in filepaths]
 
-    # create empty list to append dataframes
-    dfs = []
+    # Find the index date of each file
+    catalog = read_weekly_catalog(dir)
+    index_dates = {}
+    for filepath in filepaths:
+        entry = fresh_catalog_entry(filepath, catalog)
+        if entry is not None:
+            index_dates[filepath] = pd.Timestamp(entry["index_date"])
+        else:
+            index_dates[filepath] = index_date_from_filename(filepath)
 
-    for file in filepaths_dir:
-        # read in files
-        output = pd.read_csv(file)
-        # Add the index date to the file by extracting index from filename
-        output["index_date"] = pd.to_datetime(
-            file.split("_",)[4].split(
-                ".csv"
-            )[0],
-            dayfirst=True,
-        )
-        # Append the dataframes to the list
+    # Keep the files in the date window, if any
+    if start_date is not None:
+        filepaths = [f for f in filepaths if index_dates[f] >= pd.Timestamp(start_date)]
+    if end_date is not None:
+        filepaths = [f for f in filepaths if index_dates[f] <= pd.Timestamp(end_date)]
+
+    # order by index date
+    return sorted(filepaths, key=index_dates.get)
+
+
+def file_checksum_and_rows(filepath: str) -> Tuple[str, int]:
+    """Function to return the sha256 checksum of a csv file and its number of
+    rows (not counting the header), from a single read of the file"""
+    checksum = hashlib.sha256()
+    lines = 0
+    last_byte = b"\n"
+    with open(filepath, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            checksum.update(block)
+            lines += block.count(b"\n")
+            last_byte = block[-1:]
+    # Count a last line without a line ending
+    if last_byte != b"\n":
+        lines += 1
+    return checksum.hexdigest(), max(lines - 1, 0)
+
+
+def catalog_entry(filepath: str) -> Dict:
+    """Function to describe a weekly input csv file for the catalog: its index
+    date, size, modification time, number of rows, columns and checksum"""
+    stat = os.stat(filepath)
+    checksum, rows = file_checksum_and_rows(filepath)
+    return {
+        "index_date": index_date_from_filename(filepath).strftime("%Y-%m-%d"),
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+        "rows": rows,
+        "columns": pd.read_csv(filepath, nrows=0).columns.tolist(),
+        "checksum": checksum,
+    }
+
+
+def catalog_entry_fresh(filepath: str, entry: Dict) -> bool:
+    """Function to check whether a catalog entry describes the current version
+    of a weekly input csv file"""
+    stat = os.stat(filepath)
+    return entry["size"] == stat.st_size and entry["mtime_ns"] == stat.st_mtime_ns
+
+
+def read_weekly_catalog(dir: str) -> Dict:
+    """Function to read the catalog of the weekly input csv files in a
+    directory (see update_weekly_catalog), which is empty if it has not been
+    built"""
+    return read_cache_manifest(dir + "cache/", "catalog.json")
+
+
+def fresh_catalog_entry(filepath: str, catalog: Dict = None) -> Dict:
+    """Function to return the catalog entry of a weekly input csv file if it
+    describes the current version of the file, otherwise None. The catalog is
+    read from the file's directory unless given"""
+    if catalog is None:
+        catalog = read_weekly_catalog(os.path.dirname(filepath) + "/")
+    entry = catalog.get(os.path.basename(filepath))
+    if entry is not None and catalog_entry_fresh(filepath, entry):
+        return entry
+    return None
+
+
+def weekly_file_columns(filepath: str, catalog: Dict = None) -> List[str]:
+    """Function to return the columns of a weekly input csv file, from its
+    catalog entry where that is fresh and otherwise from the file's header"""
+    entry = fresh_catalog_entry(filepath, catalog)
+    if entry is not None:
+        return list(entry["columns"])
+    return pd.read_csv(filepath, nrows=0).columns.tolist()
+
+
+def weekly_input_rows(filepaths: List[str], dir: str) -> int:
+    """Function to return the total number of rows of the given weekly input
+    csv files, from the catalog, or None if any of them is not catalogued"""
+    catalog = read_weekly_catalog(dir)
+    rows = 0
+    for filepath in filepaths:
+        entry = fresh_catalog_entry(filepath, catalog)
+        if entry is None:
+            return None
+        rows += entry["rows"]
+    return rows
+
+
+def update_weekly_catalog(homecare_type: str, dir: str) -> Dict:
+    """Function to bring the catalog of the weekly input csv files for a
+    particular homecare type (cache/catalog.json) up to date, describing only
+    new or changed files again. Returns the catalog, keyed by filename"""
+    cache_dir = dir + "cache/"
+    os.makedirs(cache_dir, exist_ok=True)
+    catalog = read_weekly_catalog(dir)
+    filepaths = weekly_filepaths(homecare_type, dir)
+
+    updated = {}
+    for filepath in filepaths:
+        filename = os.path.basename(filepath)
+        entry = catalog.get(filename)
+        if entry is None or not catalog_entry_fresh(filepath, entry):
+            entry = catalog_entry(filepath)
+        updated[filename] = entry
+
+    if updated != catalog:
+        write_cache_manifest(cache_dir, updated, "catalog.json")
+    return updated
+
+
+def read_weekly_file(filepath: str, columns: List[str] = None) -> pd.DataFrame:
+    """Function to read a weekly input csv file, with the data types declared
+    in the population schema, and add its index date. Flags are derived from
+    the first-match dates in the file (see population_flag_dates in schema.py).
+    If columns is given only those columns are read"""
+    # Find the columns in the file and their declared data types
+    file_columns = weekly_file_columns(filepath)
+    if columns is not None:
+        columns = population_source_columns(columns)
+        file_columns = [column for column in file_columns if column in columns]
+    # read in file
+    output = pd.read_csv(
+        filepath, usecols=file_columns, dtype=population_dtypes(file_columns)
+    )
+    # Add the index date to the file by extracting index from filename
+    index_date = index_date_from_filename(filepath)
+    output = apply_population_categories(output)
+    output = derive_population_flags(output, index_date)
+    output["index_date"] = index_date
+    return output
+
+
+# Version of the cached weekly files, to be increased whenever the way they are
+# built changes (i.e. the population schema) so that existing caches are rebuilt
+cache_version = 3
+
+
+def cache_filepath(filepath: str, cache_dir: str) -> str:
+    """Function to return the path of the cached copy of a weekly input csv
+    file, which is stored as one feather file per index date"""
+    filename = os.path.splitext(os.path.basename(filepath))[0]
+    return f"{cache_dir}{filename}.feather"
+
+
+def source_signature(filepath: str, catalog: Dict = None) -> Dict:
+    """Function to return the signature of a weekly input csv file, used to
+    decide whether its cached copy is still fresh. This is the checksum from
+    the file's catalog entry where that is fresh, so that a file which is
+    rewritten unchanged keeps its cache once catalogued again, and otherwise
+    the size and modification time of the file"""
+    entry = fresh_catalog_entry(filepath, catalog)
+    if entry is not None:
+        return {"checksum": entry["checksum"], "cache_version": cache_version}
+    stat = os.stat(filepath)
+    return {
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+        "cache_version": cache_version,
+    }
+
+
+def read_cache_manifest(cache_dir: str, name: str = "manifest.json") -> Dict:
+    """Function to read the manifest recording which version of each weekly
+    input csv file the cache was built from (or another json file of the
+    cache, such as the catalog)"""
+    manifest_path = cache_dir + name
+    if not os.path.exists(manifest_path):
+        return {}
+    with open(manifest_path) as f:
+        return json.load(f)
+
+
+def write_cache_manifest(
+    cache_dir: str, manifest: Dict, name: str = "manifest.json"
+):
+    """Function to write the cache manifest (or another json file of the
+    cache), replacing any previous version in a single step so a partially
+    written manifest is never read"""
+    manifest_path = cache_dir + name
+    with open(manifest_path + ".tmp", "w") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(manifest_path + ".tmp", manifest_path)
+
+
+def write_cache_file(df: pd.DataFrame, cache_path: str):
+    """Function to write a weekly dataframe to its feather cache file"""
+    df.reset_index(drop=True).to_feather(cache_path + ".tmp")
+    os.replace(cache_path + ".tmp", cache_path)
+
+
+def load_weekly_file(
+    filepath: str,
+    cache_dir: str,
+    cached_signature: Dict = None,
+    columns: List[str] = None,
+) -> Tuple[pd.DataFrame, Dict]:
+    """Function to load a single weekly input file, reading its cached copy when
+    that is fresh and otherwise parsing the csv and rebuilding the cache. Returns
+    the dataframe (only the given columns, if any) and the signature of a
+    rebuilt cache file (or None)"""
+    cache_path = cache_filepath(filepath, cache_dir)
+    signature = source_signature(filepath)
+    # Use the cached copy if it was built from this version of the csv
+    if cached_signature == signature and os.path.exists(cache_path):
+        if columns is not None:
+            cached_columns = ipc.open_file(cache_path).schema.names
+            columns = [column for column in cached_columns if column in columns]
+        return pd.read_feather(cache_path, columns=columns), None
+    # Otherwise parse the whole csv and refresh the cached copy
+    output = read_weekly_file(filepath)
+    write_cache_file(output, cache_path)
+    if columns is not None:
+        output = output[[column for column in output.columns if column in columns]]
+    return output, signature
+
+
+def analysis_workers() -> int:
+    """Function to return the number of workers analyses may use, which is set
+    with the ANALYSIS_WORKERS environment variable (default 1)"""
+    return max(1, int(os.environ.get("ANALYSIS_WORKERS", 1)))
+
+
+@instrumented
+def load_weekly_files(
+    filepaths: List[str],
+    cache_dir: str,
+    workers: int = 1,
+    executor: str = "thread",
+    columns: List[str] = None,
+    prune: bool = True,
+) -> List[pd.DataFrame]:
+    """Function to load each weekly input file (only the given columns, if any),
+    using the columnar cache where it is fresh. With more than one worker the
+    files are read and parsed in a thread or process pool, and are returned in
+    the order of filepaths. Unless prune is False, cached copies of any other
+    files are removed"""
+    os.makedirs(cache_dir, exist_ok=True)
+    manifest = read_cache_manifest(cache_dir)
+    manifest_changed = False
+
+    # Arguments for loading each file, including the signature it was cached with
+    load_args = (
+        filepaths,
+        [cache_dir] * len(filepaths),
+        [manifest.get(os.path.basename(file)) for file in filepaths],
+        [columns] * len(filepaths),
+    )
+
+    # Load the files in order, or in a pool which submits every file up front so
+    # that reading later files overlaps with parsing earlier ones
+    if workers > 1 and len(filepaths) > 1:
+        if executor == "process":
+            # Finish any queued writes before the workers are forked
+            flush_output()
+            pool_class = ProcessPoolExecutor
+        else:
+            pool_class = ThreadPoolExecutor
+        # pyarrow sets up its pandas integration on first use, which is not
+        # thread safe, so the first file is always loaded before the pool starts
+        loaded = [load_weekly_file(*[arg[0] for arg in load_args])]
+        with pool_class(max_workers=workers) as pool:
+            loaded += list(pool.map(load_weekly_file, *[arg[1:] for arg in load_args]))
+    else:
+        loaded = list(map(load_weekly_file, *load_args))
+
+    dfs = []
+    for file, (output, signature) in zip(filepaths, loaded):
+        # Record any weeks whose cached copy was rebuilt
+        if signature is not None:
+            manifest[os.path.basename(file)] = signature
+            manifest_changed = True
         dfs.append(output)
 
+    # Remove cached copies of input files which no longer exist
+    current_files = {os.path.basename(file) for file in filepaths}
+    for filename in list(manifest):
+        if prune and filename not in current_files:
+            cache_path = cache_filepath(filename, cache_dir)
+            if os.path.exists(cache_path):
+                os.remove(cache_path)
+            del manifest[filename]
+            manifest_changed = True
+
+    if manifest_changed:
+        write_cache_manifest(cache_dir, manifest)
+
+    return dfs
+
+
+def build_population_cache(homecare_type: str):
+    """Function to build the catalog and columnar cache of the weekly input
+    files for a particular homecare type, rebuilding only those whose csv has
+    changed"""
+    dirs = homecare_type_dir(homecare_type)
+    update_weekly_catalog(homecare_type, dirs["input_dir"])
+    filepaths = weekly_filepaths(homecare_type, dirs["input_dir"])
+    load_weekly_files(filepaths, dirs["cache_dir"], workers=analysis_workers())
+
+
+def iter_weekly_chunks(
+    filepaths: List[str],
+    cache_dir: str,
+    columns: List[str] = None,
+    chunksize: int = 100000,
+) -> Iterator[pd.DataFrame]:
+    """Generator of the rows of each weekly input file in chunks (only the given
+    columns, if any), with their index date. Chunks are read from the columnar
+    cache where it is fresh and otherwise from the csv, so only one chunk is
+    held in memory at a time"""
+    manifest = read_cache_manifest(cache_dir)
+    catalogs = {}
+    for filepath in filepaths:
+        # Read the catalog of each directory of input files once
+        catalog_dir = os.path.dirname(filepath) + "/"
+        if catalog_dir not in catalogs:
+            catalogs[catalog_dir] = read_weekly_catalog(catalog_dir)
+        catalog = catalogs[catalog_dir]
+        cache_path = cache_filepath(filepath, cache_dir)
+        cache_fresh = manifest.get(
+            os.path.basename(filepath)
+        ) == source_signature(filepath, catalog) and os.path.exists(cache_path)
+        if cache_fresh:
+            # Memory map the cached copy and convert one record batch at a time
+            reader = ipc.open_file(pa.memory_map(cache_path))
+            file_columns = reader.schema.names
+            if columns is not None:
+                file_columns = [c for c in file_columns if c in columns]
+            for i in range(reader.num_record_batches):
+                batch = pa.Table.from_batches([reader.get_batch(i)])
+                yield batch.select(file_columns).to_pandas()
+        else:
+            # Find the columns in the file and their declared data types
+            file_columns = weekly_file_columns(filepath, catalog)
+            if columns is not None:
+                source_columns = population_source_columns(columns)
+                file_columns = [c for c in file_columns if c in source_columns]
+            chunks = pd.read_csv(
+                filepath,
+                usecols=file_columns,
+                dtype=population_dtypes(file_columns),
+                chunksize=chunksize,
+            )
+            index_date = index_date_from_filename(filepath)
+            for chunk in chunks:
+                chunk = apply_population_categories(chunk)
+                chunk = derive_population_flags(chunk, index_date)
+                if columns is None or "index_date" in columns:
+                    chunk["index_date"] = index_date
+                yield chunk
+
+
+@instrumented
+def weekly_sums(
+    homecare_type: str,
+    dir: str,
+    by: List[str] = None,
+    chunksize: int = 100000,
+    start_date: str = None,
+    end_date: str = None,
+) -> pd.DataFrame:
+    """Function to total each code for each week (and group of the columns
+    in by, if any) over all weekly input files for a particular homecare type
+    (or those with index dates from start_date to end_date, if given).
+    Rows are streamed from the files in chunks and folded into the totals, so
+    the population is never held in memory. These weekly totals are the base
+    which analyses roll up to their resolution (see rollups.py). The headers
+    are renamed to the terms they refer to"""
+    headers_dict = create_headers_dict(homecare_type)
+    headers = list(headers_dict)
+    by = by or []
+    keys = ["index_date"] + by
+
+    chunks = iter_weekly_chunks(
+        weekly_filepaths(homecare_type, dir, start_date, end_date),
+        dir + "cache/",
+        columns=keys + headers,
+        chunksize=chunksize,
+    )
+    chunk_sums = []
+    for chunk in chunks:
+        # Group by week, with grouping columns as plain values so that totals
+        # from chunks with different categories line up
+        for column in by:
+            chunk[column] = chunk[column].astype(object)
+        chunk_sums.append(chunk.groupby(keys)[headers].sum().astype("int64"))
+
+    # Add up the totals of the chunks once, keeping the integer counts
+    if chunk_sums:
+        sums = pd.concat(chunk_sums).groupby(level=keys).sum().reset_index()
+    else:
+        sums = pd.DataFrame(columns=keys + headers)
+        sums = sums.astype({header: "int64" for header in headers})
+        sums["index_date"] = pd.to_datetime(sums["index_date"])
+    sums.rename(columns=headers_dict, inplace=True)
+    return sums
+
+
+@instrumented
+def create_population_df(
+    homecare_type: str,
+    dir: str,
+    workers: int = None,
+    executor: str = "thread",
+    columns: List[str] = None,
+    start_date: str = None,
+    end_date: str = None,
+) -> pd.DataFrame:
+    """Function to create population data frame for a particular homecare type
+    which includes all weeks and create a dictionary of cohort size for each
+    individual week. The weekly files are loaded by a pool of workers (thread or
+    process) when workers, or the ANALYSIS_WORKERS environment variable, is > 1.
+    If columns is given (using the renamed headers, i.e. code terms) only those
+    columns and index_date are loaded, and if start_date or end_date is given
+    only the weeks with index dates in that window are. Patients are given a
+    dense patient_ordinal (see patient_sets.py)"""
+    # find the input csv files in the date window
+    filepaths = weekly_filepaths(homecare_type, dir, start_date, end_date)
+    window = start_date is not None or end_date is not None
+
+    # Convert the requested columns to the headers used in the input files
+    headers_dict = create_headers_dict(homecare_type)
+    if columns is not None:
+        input_headers = {v: k for k, v in headers_dict.items()}
+        columns = [input_headers.get(column, column) for column in columns]
+        columns = columns + ["index_date"]
+
+    # Read each week from the columnar cache, rebuilding any stale weeks
+    if workers is None:
+        workers = analysis_workers()
+    # (keeping the cached copies of weeks outside the date window)
+    dfs = load_weekly_files(
+        filepaths, dir + "cache/", workers, executor, columns, prune=not window
+    )
+
     # Combine all the dataframes together
-    population_df = pd.concat(dfs)
+    population_df = concat_population(dfs)
+
+    # Number the patients once, for distinct patient counts
+    if "patient_id" in population_df.columns:
+        population_df["patient_ordinal"] = dense_patient_ordinals(
+            population_df["patient_id"]
+        )
 
     # Rename the headers
-    headers_dict = create_headers_dict(homecare_type)
     population_df.rename(columns=headers_dict, inplace=True)
 
     return population_df
 
+
 def homecare_type_dir(homecare_type: str) -> Dict[str, str]:
     """Function to return a dictionary containing the input directory
-    (location of the relevant input csv files) and output directory (where to
+    (location of the relevant input csv files), cache directory (location of
+    the columnar copy of the input files), aggregates directory (location of
+    the partial aggregates of each input file) and output directory (where to
     store the analysis outputs) for a specific homecare type"""
     return dict(
         input_dir=f"output/{homecare_type}/0.2_join_cohorts/",
+        cache_dir=f"output/{homecare_type}/0.2_join_cohorts/cache/",
+        aggregates_dir=f"output/{homecare_type}/0.2_join_cohorts/aggregates/",
         output_dir=f"output/{homecare_type}/0.3_analysis_outputs/",
     )
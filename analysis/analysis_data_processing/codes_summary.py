@@ -1,3 +1,5 @@
+from typing import List
+import numpy as np
 import pandas as pd
 import sys
 
@@ -8,6 +10,12 @@ from analysis.analysis_data_processing.analysis_data_processing import (
     create_population_df,
     homecare_type_dir,
 )
+from analysis.analysis_data_processing.instrumentation import instrumented
+from analysis.analysis_data_processing.output_writer import write_table
+from analysis.analysis_data_processing.patient_sets import (
+    distinct_counts,
+    patient_ordinals,
+)
 from analysis.analysis_data_processing.redaction import redact_and_round_df
 
 
@@ -17,21 +25,84 @@ def number_of_uses_of_code(homecare_type: str, df: pd.DataFrame):
 
     dirs = homecare_type_dir(homecare_type)
 
+    ordinals, n_patients = patient_ordinals(df)
+
     i = 1
     for header in df.columns[1:]:
-        code_summary = df.groupby(header)["patient_id"].nunique()
-        code_summary_df = pd.DataFrame(code_summary)
-        code_summary_df.rename(
-            columns={"patient_id": "Total number of patients"},
-            inplace=True,
+        # Count the distinct patients with each number of uses
+        value_codes, values = pd.factorize(df[header], sort=True)
+        code_summary_df = pd.DataFrame(
+            {
+                "Total number of patients": distinct_counts(
+                    ordinals, value_codes, len(values), n_patients
+                )
+            },
+            index=pd.Index(values, name=header),
         )
         # Round and redact dataframe and save to csv
-        redact_and_round_df(code_summary_df).to_csv(
-            f"""{dirs["output_dir"]}{homecare_type}_table_code_counts_{i}_{header.replace (" ", "_")}.csv"""
+        write_table(
+            redact_and_round_df(code_summary_df),
+            f"""{dirs["output_dir"]}{homecare_type}_table_code_counts_{i}_{header.replace (" ", "_")}.csv""",
         )
         i = i + 1
 
 
+def code_bitmasks(codes_df: pd.DataFrame) -> np.ndarray:
+    """Function to encode which codes each row has (i.e. a total of at least 1)
+    as the bits of an integer, with the first column as the highest bit"""
+    n_codes = codes_df.shape[1]
+    if n_codes > 64:
+        raise ValueError(f"Cannot encode {n_codes} codes in a 64 bit mask")
+    bits = np.left_shift(np.uint64(1), np.arange(n_codes - 1, -1, -1, dtype=np.uint64))
+    has_code = (codes_df.to_numpy() >= 1).astype(np.uint64)
+    return (has_code * bits).sum(axis=1, dtype=np.uint64)
+
+
+def decode_bitmasks(bitmasks: np.ndarray, headers: List[str]) -> pd.Index:
+    """Function to decode bitmasks (see code_bitmasks) into a flag (0 or 1) for
+    each code, as an index with a level per code like that of a groupby on the
+    code columns"""
+    n_codes = len(headers)
+    bitmasks = np.asarray(bitmasks, dtype=np.uint64)
+    flags = [
+        ((bitmasks >> np.uint64(n_codes - 1 - i)) & np.uint64(1)).astype(np.int64)
+        for i in range(n_codes)
+    ]
+    if n_codes == 1:
+        return pd.Index(flags[0], name=headers[0])
+    return pd.MultiIndex.from_arrays(flags, names=headers)
+
+
+def combination_matches(
+    bitmasks: np.ndarray,
+    headers: List[str],
+    present: List[str] = None,
+    absent: List[str] = None,
+) -> np.ndarray:
+    """Function to find which bitmasks (see code_bitmasks) have all of the codes
+    in present and none of the codes in absent, e.g. to count the patients with
+    code A and B but not C from their bitmasks or from combination counts:
+
+    counts = combination_counts(patient_codes[headers])
+    counts[combination_matches(counts.index, headers, [A, B], [C])].sum()"""
+    n_codes = len(headers)
+    present_bits = sum(
+        1 << (n_codes - 1 - headers.index(code)) for code in present or []
+    )
+    absent_bits = sum(1 << (n_codes - 1 - headers.index(code)) for code in absent or [])
+    bitmasks = np.asarray(bitmasks, dtype=np.uint64)
+    return ((bitmasks & np.uint64(present_bits)) == np.uint64(present_bits)) & (
+        (bitmasks & np.uint64(absent_bits)) == 0
+    )
+
+
+def combination_counts(codes_df: pd.DataFrame) -> pd.Series:
+    """Function to count the rows (i.e. patients) with each combination of
+    codes, indexed by the bitmask of the combination in ascending order. The
+    counts are not redacted"""
+    return pd.Series(code_bitmasks(codes_df)).value_counts().sort_index()
+
+
 def code_combinations(
     homecare_type: str,
     df: pd.DataFrame,
@@ -41,17 +112,17 @@ def code_combinations(
 
     dirs = homecare_type_dir(homecare_type)
 
-    # Set the index of the dataframe to be patient id
-    df.set_index("patient_id", inplace=True, drop=True)
-
-    # Set totals to flags in the patient code dataframe
-    df = df.mask(df >= 1, 1)
+    # Count the patients (one row each) with each combination of codes, as
+    # bitmasks with the first code as the highest bit so that combinations are
+    # in the same order as a groupby on the code columns would give
+    headers = df.columns.drop("patient_id").tolist()
+    counts = combination_counts(df[headers])
 
-    # Group by all codes and total the number of unique patients
-    df = df.reset_index().groupby(df.columns.tolist())["patient_id"].nunique()
-
-    # Convert to dataframe
-    df = pd.DataFrame(df)
+    # Convert to dataframe with a flag for each code
+    df = pd.DataFrame(
+        {"patient_id": counts.to_numpy()},
+        index=decode_bitmasks(counts.index.to_numpy(), headers),
+    )
 
     # Rename column header
     df.rename(
@@ -59,8 +130,9 @@ def code_combinations(
     )
 
     # Round and redact dataframe and save to csv
-    redact_and_round_df(df).to_csv(
-        dirs["output_dir"] + homecare_type + "_table_code_combinations.csv"
+    write_table(
+        redact_and_round_df(df),
+        dirs["output_dir"] + homecare_type + "_table_code_combinations.csv",
     )
 
 
@@ -70,25 +142,35 @@ def code_population(homecare_type: str, df: pd.DataFrame, headers: str):
 
     dirs = homecare_type_dir(homecare_type)
 
+    ordinals, n_patients = patient_ordinals(df)
+    date_codes, dates = pd.factorize(df["index_date"], sort=True)
+
     i = 1
     for header in headers:
-        code_summary = df[df[header] > 0]
-        code_summary = code_summary.groupby(["index_date"])["patient_id"].nunique()
-        code_summary_df = pd.DataFrame(code_summary)
-        code_summary_df.rename(
-            columns={"patient_id": "Total number of patients"},
-            inplace=True,
+        # Count the distinct patients with the code on each index date which
+        # has any
+        has_code = df[header].to_numpy() > 0
+        counts = distinct_counts(
+            ordinals[has_code], date_codes[has_code], len(dates), n_patients
+        )
+        present = np.flatnonzero(counts)
+        code_summary_df = pd.DataFrame(
+            {"Total number of patients": counts[present]},
+            index=pd.Index(dates.take(present), name="index_date"),
         )
         # Round and redact dataframe and save to csv
-        redact_and_round_df(code_summary_df).to_csv(
-            f"""{dirs["output_dir"]}{homecare_type}_table_patient_id_total_{i}_{header.replace (" ", "_")}.csv"""
+        write_table(
+            redact_and_round_df(code_summary_df),
+            f"""{dirs["output_dir"]}{homecare_type}_table_patient_id_total_{i}_{header.replace (" ", "_")}.csv""",
         )
         i = i + 1
 
 
-def code_analysis(homecare_type: str):
+@instrumented
+def code_analysis(homecare_type: str, population_df: pd.DataFrame = None):
     """Function to summarise how many times patients received each code over the
-    entire time period and how many times each possible combination of codes occured"""
+    entire time period and how many times each possible combination of codes occured.
+    Uses population_df if given, otherwise loads it"""
 
     dirs = homecare_type_dir(homecare_type)
 
@@ -98,7 +180,10 @@ def code_analysis(homecare_type: str):
 
     # Create population data frame which includes all weeks and dictionary of
     # cohort size for each individual week
-    population_df = create_population_df(homecare_type, dirs["input_dir"])
+    if population_df is None:
+        population_df = create_population_df(
+            homecare_type, dirs["input_dir"], columns=["patient_id"] + headers
+        )
 
     # Total the number of codes per patient over the full time period
     patient_codes = population_df.groupby("patient_id")[headers].sum().reset_index()
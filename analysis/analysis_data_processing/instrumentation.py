@@ -0,0 +1,292 @@
+from contextlib import contextmanager
+from typing import Callable, Dict, Tuple
+import cProfile
+import functools
+import json
+import math
+import os
+import threading
+import time
+import pandas as pd
+
+# resource is only available on Unix, where the analyses are run
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# Measurements of each stage of the current run, keyed by stage name. Stages
+# may be nested, so the time of a stage includes that of the stages it calls
+stage_records = {}
+
+# Stages may be recorded from several threads (i.e. plots saved by an output
+# writer), so the records are changed under a lock
+stage_records_lock = threading.Lock()
+
+# Names of the stages being profiled (only the outermost profiled stage is, as
+# profilers cannot be nested)
+profiled_stages = []
+
+# Interval in seconds at which the resident set size is sampled while any stage
+# is running, to find the peak of each stage
+rss_sample_interval = 0.01
+
+
+def rss_mb(who: str = "self") -> float:
+    """Function to return the peak resident set size over the lifetime of this
+    process (or of its finished child processes, i.e. pool workers) in MB"""
+    if resource is None:
+        return None
+    usage = resource.getrusage(
+        resource.RUSAGE_SELF if who == "self" else resource.RUSAGE_CHILDREN
+    )
+    return usage.ru_maxrss / 1024
+
+
+def current_rss_mb() -> float:
+    """Function to return the current resident set size of this process in MB,
+    or None where it cannot be read (/proc is only available on Linux)"""
+    try:
+        with open("/proc/self/statm") as f:
+            pages = int(f.read().split()[1])
+    except (OSError, IndexError, ValueError):
+        return None
+    return pages * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024)
+
+
+class RSSSampler:
+    """Thread which samples the resident set size of this process while any
+    stage is running, keeping the peak of each running stage. There is one
+    sampler per process, started on first use"""
+
+    def __init__(self):
+        self.pid = os.getpid()
+        self.lock = threading.Lock()
+        # Peaks of the running stages, keyed by id of their measurement
+        self.peaks = {}
+        self.running = threading.Event()
+        threading.Thread(target=self.sample, daemon=True).start()
+
+    def sample(self):
+        """Function run by the sampler thread, updating the peak of every
+        running stage at each interval"""
+        while True:
+            self.running.wait()
+            time.sleep(rss_sample_interval)
+            rss = current_rss_mb()
+            if rss is None:
+                continue
+            with self.lock:
+                for key, peak in self.peaks.items():
+                    self.peaks[key] = max(peak, rss)
+
+    def start(self, key: int, rss: float):
+        """Function to start keeping the peak of a stage, from its starting
+        resident set size"""
+        with self.lock:
+            self.peaks[key] = rss
+            self.running.set()
+
+    def stop(self, key: int, rss: float) -> float:
+        """Function to stop keeping the peak of a stage, given its final
+        resident set size, and return the peak"""
+        with self.lock:
+            peak = max(self.peaks.pop(key), rss or 0)
+            if not self.peaks:
+                self.running.clear()
+        return peak
+
+
+# Sampler of this process (pool workers start their own)
+_rss_sampler = None
+_rss_sampler_lock = threading.Lock()
+
+
+def rss_sampler() -> RSSSampler:
+    """Function to return the resident set size sampler of this process"""
+    global _rss_sampler
+    with _rss_sampler_lock:
+        if _rss_sampler is None or _rss_sampler.pid != os.getpid():
+            _rss_sampler = RSSSampler()
+        return _rss_sampler
+
+
+def children_cpu_seconds() -> float:
+    """Function to return the CPU time used by finished child processes"""
+    if resource is None:
+        return 0.0
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+def reset_stage_records():
+    """Function to clear the measurements of previous stages"""
+    with stage_records_lock:
+        stage_records.clear()
+
+
+def record_stage(name: str, measurement: Dict):
+    """Function to add the measurement of one call of a stage to its record"""
+    merge_stage_record(name, dict(measurement, calls=1))
+
+
+def merge_stage_record(name: str, measurement: Dict):
+    """Function to add the measurement of one or more calls of a stage (i.e.
+    the record of the stage in a pool worker) to its record"""
+    with stage_records_lock:
+        record = stage_records.setdefault(
+            name,
+            {
+                "calls": 0,
+                "wall_seconds": 0.0,
+                "cpu_seconds": 0.0,
+                "children_cpu_seconds": 0.0,
+                "peak_rss_mb": None,
+                "rss_growth_mb": None,
+                "rows": None,
+                "input_rows": None,
+            },
+        )
+        record["calls"] += measurement["calls"]
+        for key in ["wall_seconds", "cpu_seconds", "children_cpu_seconds"]:
+            record[key] += measurement[key]
+        for key in ["peak_rss_mb", "rss_growth_mb"]:
+            if measurement[key] is not None:
+                record[key] = max(record[key] or 0, measurement[key])
+        for key in ["rows", "input_rows"]:
+            if measurement[key] is not None:
+                record[key] = (record[key] or 0) + measurement[key]
+
+
+def merge_stage_records(records: Dict):
+    """Function to add the records of the stages run by a pool worker (see
+    call_with_stage_records) to those of this process. The times of stages
+    run by several workers at once add up, so may exceed the wall time of the
+    stage which started the pool"""
+    for name, record in records.items():
+        merge_stage_record(name, record)
+
+
+def call_with_stage_records(function: Callable, *args, **kwargs) -> Tuple:
+    """Function to call a function in a pool worker, returning its result and
+    the records of the stages it ran, which the process that started the pool
+    adds to its own with merge_stage_records"""
+    reset_stage_records()
+    result = function(*args, **kwargs)
+    return result, dict(stage_records)
+
+
+@contextmanager
+def stage(name: str, profile: bool = True):
+    """Context manager to measure the wall time, CPU time and peak memory (the
+    peak resident set size sampled while the stage runs) of a stage of the
+    analysis. Stages run on a thread other than the main thread (i.e. by an
+    output writer) measure the CPU time of that thread only. Yields a
+    dictionary in which the number of rows the stage produced (rows) and used
+    (input_rows) can be recorded. If the
+    ANALYSIS_PROFILE_DIR environment variable is set and profile is True, the
+    stage is profiled (unless it is within another profiled stage) and the
+    profile saved to <ANALYSIS_PROFILE_DIR>/<name>_<process id>_<call>.prof"""
+    measurement = {"rows": None, "input_rows": None}
+
+    profile_dir = os.environ.get("ANALYSIS_PROFILE_DIR")
+    profiler = None
+    if profile and profile_dir and not profiled_stages:
+        profiler = cProfile.Profile()
+        profiled_stages.append(name)
+        profiler.enable()
+
+    if threading.current_thread() is threading.main_thread():
+        cpu_time = time.process_time
+    else:
+        cpu_time = time.thread_time
+
+    start_rss = current_rss_mb()
+    if start_rss is not None:
+        sampler = rss_sampler()
+        sampler.start(id(measurement), start_rss)
+    start_wall = time.perf_counter()
+    start_cpu = cpu_time()
+    start_children_cpu = children_cpu_seconds()
+    try:
+        yield measurement
+    finally:
+        measurement["wall_seconds"] = time.perf_counter() - start_wall
+        measurement["cpu_seconds"] = cpu_time() - start_cpu
+        measurement["children_cpu_seconds"] = (
+            children_cpu_seconds() - start_children_cpu
+        )
+        if start_rss is None:
+            measurement["peak_rss_mb"] = measurement["rss_growth_mb"] = None
+        else:
+            measurement["peak_rss_mb"] = sampler.stop(
+                id(measurement), current_rss_mb()
+            )
+            measurement["rss_growth_mb"] = measurement["peak_rss_mb"] - start_rss
+        if profiler is not None:
+            profiler.disable()
+            profiled_stages.pop()
+            os.makedirs(profile_dir, exist_ok=True)
+            calls = stage_records.get(name, {}).get("calls", 0) + 1
+            profiler.dump_stats(
+                os.path.join(profile_dir, f"{name}_{os.getpid()}_{calls}.prof")
+            )
+        record_stage(name, measurement)
+
+
+def data_rows(value) -> int:
+    """Function to return the number of rows of a dataframe (or of the first
+    item of a tuple, if that is a dataframe), or None for anything else"""
+    if isinstance(value, tuple) and value:
+        value = value[0]
+    if isinstance(value, (pd.DataFrame, pd.Series)):
+        return len(value)
+    return None
+
+
+def instrumented(function):
+    """Decorator to measure each call of a function as a stage named after it
+    (see stage), recording the rows of the first dataframe it is given and of
+    the dataframe it returns"""
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        with stage(function.__name__) as measurement:
+            for arg in list(args) + list(kwargs.values()):
+                if data_rows(arg) is not None:
+                    measurement["input_rows"] = data_rows(arg)
+                    break
+            result = function(*args, **kwargs)
+            measurement["rows"] = data_rows(result)
+        return result
+
+    return wrapper
+
+
+def rounded_rows(rows: int):
+    """Function to round a row count up to the nearest 5, and redact counts of 5
+    or less, like the counts in the analysis outputs"""
+    if rows is None:
+        return None
+    return "[REDACTED]" if rows <= 5 else 5 * math.ceil(rows / 5)
+
+
+def write_run_report(homecare_type: str, output_dir: str) -> Dict:
+    """Function to save the measurements of each stage of the run to
+    <homecare_type>_run_report.json in output_dir, with row counts rounded
+    and redacted, and the peak resident set size over the lifetime of this
+    process and of its finished pool workers. Returns the report"""
+    stages = {}
+    for name, record in stage_records.items():
+        stages[name] = dict(record)
+        stages[name]["rows"] = rounded_rows(record["rows"])
+        stages[name]["input_rows"] = rounded_rows(record["input_rows"])
+    report = {
+        "homecare_type": homecare_type,
+        "peak_rss_mb": rss_mb(),
+        "children_peak_rss_mb": rss_mb("children"),
+        "stages": stages,
+    }
+    with open(f"{output_dir}{homecare_type}_run_report.json", "w") as f:
+        json.dump(report, f, indent=2)
+    return report
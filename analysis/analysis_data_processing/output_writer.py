@@ -0,0 +1,189 @@
+from contextlib import contextmanager
+from typing import Callable, Dict, List
+import atexit
+import json
+import os
+import queue
+import threading
+import time
+import pandas as pd
+
+
+class OutputWriter:
+    """Service which writes output files (tables and plots) on background
+    threads, so that computation continues while files are serialised. Writes
+    wait in a bounded queue, so at most max_pending outputs are held in memory.
+    Errors are raised by flush (or close), and close saves a manifest of every
+    file written"""
+
+    def __init__(
+        self, manifest_filepath: str = None, workers: int = 2, max_pending: int = 16
+    ):
+        self.manifest_filepath = manifest_filepath
+        # Pool workers forked while the writer is active inherit it without its
+        # threads, so it is only used by the process which created it
+        self.pid = os.getpid()
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.lock = threading.Lock()
+        self.files = []
+        self.errors = []
+        self.closed = False
+        self.threads = [
+            threading.Thread(target=self.work, daemon=True) for _ in range(workers)
+        ]
+        for thread in self.threads:
+            thread.start()
+        # Flush the queue before the interpreter exits, even if close is not
+        # called
+        atexit.register(self.close)
+
+    def work(self):
+        """Function run by each worker thread, writing queued outputs until it
+        is given None"""
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                write, kind, filepath = item
+                start = time.perf_counter()
+                try:
+                    write()
+                    self.record(filepath, kind, time.perf_counter() - start)
+                except Exception as error:
+                    with self.lock:
+                        self.errors.append((filepath, error))
+            finally:
+                self.queue.task_done()
+
+    def record(self, filepath: str, kind: str, seconds: float = None):
+        """Function to add a written file to the manifest, with the time taken
+        to write it if it was written by this writer"""
+        record = {
+            "filepath": filepath,
+            "kind": kind,
+            "bytes": os.path.getsize(filepath),
+            "seconds": None if seconds is None else round(seconds, 4),
+        }
+        with self.lock:
+            self.files.append(record)
+
+    def submit(self, write: Callable, kind: str, filepath: str):
+        """Function to queue a write of filepath, waiting for room in the queue
+        if it is full. Raises any error of an earlier write"""
+        if self.closed:
+            raise ValueError("Output writer is closed")
+        self.raise_errors()
+        self.queue.put((write, kind, filepath))
+
+    def raise_errors(self):
+        """Function to raise the first error of any write so far"""
+        with self.lock:
+            errors, self.errors = self.errors, []
+        if errors:
+            filepath, error = errors[0]
+            raise OSError(
+                f"Failed to write {filepath} ({len(errors)} failed writes)"
+            ) from error
+
+    def flush(self):
+        """Function to wait for every queued write, raising any error"""
+        self.queue.join()
+        self.raise_errors()
+
+    def close(self, raise_errors: bool = True):
+        """Function to finish every queued write, stop the worker threads and
+        save the manifest, raising any error unless raise_errors is False.
+        Closing again does nothing"""
+        if self.closed:
+            return
+        self.closed = True
+        atexit.unregister(self.close)
+        self.queue.join()
+        for _ in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        if self.manifest_filepath is not None:
+            write_output_manifest(self.manifest_filepath, self.files)
+        if raise_errors:
+            self.raise_errors()
+
+
+# Output writers opened by output_writer, the last of which is active
+active_writers = []
+
+
+def write_output_manifest(filepath: str, files: List[Dict]):
+    """Function to save the manifest of the files written by an output writer,
+    in order of their paths"""
+    with open(filepath, "w") as f:
+        json.dump(
+            {"files": sorted(files, key=lambda file: file["filepath"])}, f, indent=2
+        )
+
+
+@contextmanager
+def output_writer(
+    manifest_filepath: str = None, workers: int = 2, max_pending: int = 16
+):
+    """Context manager within which tables and plots saved by write_table and
+    save_plot are written by an OutputWriter on background threads. All of
+    them are written on leaving the context, and any error of those writes
+    raised if the context is left without an error of its own"""
+    writer = OutputWriter(manifest_filepath, workers, max_pending)
+    active_writers.append(writer)
+    try:
+        yield writer
+    except BaseException:
+        # Finish the writes without raising their errors, which would hide the
+        # error the context is being left with
+        active_writers.remove(writer)
+        writer.close(raise_errors=False)
+        raise
+    active_writers.remove(writer)
+    writer.close()
+
+
+def active_writer() -> OutputWriter:
+    """Function to return the active output writer of this process, or None"""
+    if active_writers and active_writers[-1].pid == os.getpid():
+        return active_writers[-1]
+    return None
+
+
+def flush_output():
+    """Function to wait for every write queued with the active output writer,
+    if there is one. Called before starting a process pool, so that the pool
+    workers are not forked while a writer thread is saving a file and holding
+    its locks"""
+    writer = active_writer()
+    if writer is not None:
+        writer.flush()
+
+
+def write_output(write: Callable, kind: str, filepath: str):
+    """Function to write an output file with the active output writer, or
+    straight away if there is none"""
+    writer = active_writer()
+    if writer is not None:
+        writer.submit(write, kind, filepath)
+    else:
+        write()
+
+
+def record_output(filepath: str, kind: str):
+    """Function to add a file written by another process (i.e. a pool worker)
+    to the manifest of the active output writer, if there is one"""
+    writer = active_writer()
+    if writer is not None:
+        writer.record(filepath, kind)
+
+
+def write_table(df: pd.DataFrame, filepath: str, **kwargs):
+    """Function to save a dataframe to a csv file (with to_csv's keyword
+    arguments), using the active output writer if there is one. The dataframe
+    is copied when queued, so it may be changed straight afterwards"""
+    if active_writer() is not None:
+        df = df.copy()
+    write_output(lambda: df.to_csv(filepath, **kwargs), "table", filepath)
@@ -0,0 +1,95 @@
+from typing import Tuple
+import numpy as np
+import pandas as pd
+
+# Sets of patients are stored as bitmaps over dense patient ordinals (0, 1, 2,
+# ...): bit (ordinal % 8) of byte (ordinal // 8) is set if the patient is in
+# the set. The number of patients in a set is then a popcount, and the union of
+# sets (i.e. of weeks into months) a bitwise OR. Each bitmap is padded to a whole
+# number of 64 bit words so that it can be counted a word at a time
+
+# Number of bits set in each possible byte
+popcount_table = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+# Approximate number of bytes of bitmaps to build or count at once
+bitmap_block_bytes = 64 * 2**20
+
+
+def dense_patient_ordinals(patient_id: pd.Series) -> np.ndarray:
+    """Function to number the patients 0, 1, 2, ... in order of first
+    appearance, as int32"""
+    return pd.factorize(patient_id)[0].astype(np.int32)
+
+
+def patient_ordinals(df: pd.DataFrame) -> Tuple[np.ndarray, int]:
+    """Function to return the patient ordinal of each row of a dataframe (from
+    the patient_ordinal column added by the loader, or else numbering the
+    patient_ids) and the number of patients"""
+    if "patient_ordinal" in df.columns:
+        ordinals = df["patient_ordinal"].to_numpy()
+    else:
+        ordinals = dense_patient_ordinals(df["patient_id"])
+    n_patients = int(ordinals.max()) + 1 if len(ordinals) else 0
+    return ordinals, n_patients
+
+
+def patient_bitmaps(
+    ordinals: np.ndarray, groups: np.ndarray, n_groups: int, n_patients: int
+) -> np.ndarray:
+    """Function to return the set of patients in each group (numbered 0 to
+    n_groups - 1) as an array with a bitmap of n_patients bits for each group"""
+    bitmaps = np.zeros((n_groups, (n_patients + 63) // 64 * 8), dtype=np.uint8)
+    ordinals = np.asarray(ordinals, dtype=np.int64)
+    np.bitwise_or.at(
+        bitmaps,
+        (np.asarray(groups, dtype=np.int64), ordinals >> 3),
+        np.left_shift(1, ordinals & 7).astype(np.uint8),
+    )
+    return bitmaps
+
+
+def popcount(bitmaps: np.ndarray) -> np.ndarray:
+    """Function to return the number of patients in each bitmap of a 2D array
+    of bitmaps from patient_bitmaps. The bitmaps are counted a block at a time,
+    so the temporary bit counts stay within about bitmap_block_bytes"""
+    n_groups, n_bytes = bitmaps.shape
+    counts = np.zeros(n_groups, dtype=np.int64)
+    block = max(1, bitmap_block_bytes // max(n_bytes, 1))
+    for first in range(0, n_groups, block):
+        rows = bitmaps[first : first + block]
+        if hasattr(np, "bitwise_count"):
+            # Count a 64 bit word at a time where numpy can (version 2 onwards)
+            bits = np.bitwise_count(np.ascontiguousarray(rows).view(np.uint64))
+        else:
+            bits = popcount_table[rows]
+        counts[first : first + block] = bits.sum(axis=-1, dtype=np.int64)
+    return counts
+
+
+def distinct_counts(
+    ordinals: np.ndarray, groups: np.ndarray, n_groups: int, n_patients: int
+) -> np.ndarray:
+    """Function to return the number of distinct patients in each group
+    (numbered 0 to n_groups - 1), given the ordinal and group of each row. The
+    bitmaps are built and counted for a block of groups at a time, so at most
+    about bitmap_block_bytes of them are held in memory"""
+    groups = np.asarray(groups, dtype=np.int64)
+    ordinals = np.asarray(ordinals)
+    block = max(1, bitmap_block_bytes // max((n_patients + 63) // 64 * 8, 1))
+    if block >= n_groups:
+        return popcount(patient_bitmaps(ordinals, groups, n_groups, n_patients))
+
+    # Sort the rows by group so that each block of groups is a slice of rows
+    order = np.argsort(groups, kind="stable")
+    groups = groups[order]
+    ordinals = ordinals[order]
+    firsts = np.arange(0, n_groups, block)
+    bounds = np.append(np.searchsorted(groups, firsts), len(groups))
+    counts = np.zeros(n_groups, dtype=np.int64)
+    for i, first in enumerate(firsts):
+        n_block = min(block, n_groups - first)
+        rows = slice(bounds[i], bounds[i + 1])
+        counts[first : first + n_block] = popcount(
+            patient_bitmaps(ordinals[rows], groups[rows] - first, n_block, n_patients)
+        )
+    return counts
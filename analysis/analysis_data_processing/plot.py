@@ -1,4 +1,8 @@
-import matplotlib.pyplot as plt
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from fnmatch import fnmatch
+from typing import Dict, List
+import json
+import os
 import pandas as pd
 import numpy as np
 import sys
@@ -8,6 +12,35 @@ from textwrap import wrap
 if "." not in sys.path:
     sys.path.insert(0, ".")
 from analysis.analysis_data_processing.analysis_data_processing import homecare_type_dir
+from analysis.analysis_data_processing.instrumentation import (
+    call_with_stage_records,
+    instrumented,
+    merge_stage_records,
+    stage,
+)
+from analysis.analysis_data_processing.output_writer import (
+    flush_output,
+    record_output,
+    write_output,
+)
+from analysis.analysis_data_processing.rollups import (
+    default_resolution,
+    resolution_suffix,
+)
+
+
+def new_figure(figure_size: tuple):
+    """Function to create a figure, importing matplotlib on first use rather
+    than on import of this module so that table-only work does not import it.
+    The figure is not managed by pyplot, so it holds no global state, can be
+    saved on another thread and is released once it is no longer used"""
+    import matplotlib
+
+    # Plots are only saved to files, so use a backend without a display
+    matplotlib.use("Agg")
+    from matplotlib.figure import Figure
+
+    return Figure(figsize=figure_size)
 
 
 def produce_plot(
@@ -17,25 +50,203 @@ def produce_plot(
     y_label: str = None,
     figure_size: tuple = (20, 10),
 ):
-    """Function to produce plot of all dataframe columns"""
-    fig, ax = plt.subplots(figsize=figure_size)
+    """Function to produce plot of all dataframe columns. Returns the figure,
+    which should be saved with save_plot"""
+    fig = new_figure(figure_size)
+    ax = fig.subplots()
     df.replace(["[REDACTED]"], np.nan).plot(ax=ax)
-    plt.legend(loc="upper left", bbox_to_anchor=(1.0, 1.0), fontsize=20)
-    plt.xlabel(x_label, fontsize=20)
-    plt.ylabel(y_label, fontsize=20)
-    plt.title("\n".join(wrap(title)), fontsize=40)
+    ax.legend(loc="upper left", bbox_to_anchor=(1.0, 1.0), fontsize=20)
+    ax.set_xlabel(x_label, fontsize=20)
+    ax.set_ylabel(y_label, fontsize=20)
+    ax.set_title("\n".join(wrap(title)), fontsize=40)
+    return fig
 
 
-def produce_pivot_plot(
+def png_filepath(filepath: str) -> str:
+    """Function to return the path of the png file a plot is saved to"""
+    return filepath if filepath.endswith(".png") else filepath + ".png"
+
+
+def save_plot(fig, filepath: str):
+    """Function to save a figure as a png file, using the active output writer
+    if there is one (see output_writer.py). The saving is measured as the
+    save_plot stage, on whichever thread it runs"""
+    filepath = png_filepath(filepath)
+
+    def write():
+        with stage("save_plot", profile=False):
+            fig.savefig(filepath, bbox_inches="tight")
+
+    write_output(write, "plot", filepath)
+
+
+def plot_data(job: Dict) -> pd.DataFrame:
+    """Function to load the data of a plot job from its saved table: the rows
+    matching job["filter"], pivoted by job["pivot"] if given, indexed by
+    job["index"] (as periods of job["index_freq"]) and with the columns
+    job["series"] as numbers (so that redacted values are missing)"""
+    pivot = job.get("pivot")
+    # Read labels of the pivot column as text, as they are in the plot legend
+    dtype = {pivot["columns"]: str} if pivot else None
+    df = pd.read_csv(job["table"], index_col=0, dtype=dtype)
+
+    # Keep only the rows of the plot
+    for column, value in job.get("filter", {}).items():
+        df = df.loc[df[column].astype(str) == value]
+
+    if pivot:
+        df = df.pivot(
+            index=job["index"], columns=pivot["columns"], values=pivot["values"]
+        )
+    else:
+        df = df.set_index(job["index"])
+    if job.get("index_freq"):
+        df.index = pd.PeriodIndex(df.index, freq=job["index_freq"])
+
+    return df[job["series"]].apply(pd.to_numeric, errors="coerce")
+
+
+def plot_spec(job: Dict) -> Dict:
+    """Function to return the description of a plot job without its data, as
+    saved in plot manifests"""
+    return {key: value for key, value in job.items() if key != "df"}
+
+
+def render_plot(job: Dict) -> bool:
+    """Function to produce and save a plot of all columns of job["df"] (or of
+    the data loaded by plot_data if there is no dataframe) to job["filepath"],
+    with the given title and axis labels. Returns whether the plot was saved,
+    or raises the error unless job["ignore_errors"]"""
+    try:
+        df = job["df"] if "df" in job else plot_data(job)
+        fig = produce_plot(df, job["title"], job.get("x_label"), job.get("y_label"))
+        save_plot(fig, job["filepath"])
+    except Exception:
+        if job.get("ignore_errors"):
+            return False
+        raise
+    return True
+
+
+@instrumented
+def render_plots(jobs: List[Dict], workers: int = 1) -> List[bool]:
+    """Function to render plot jobs (see render_plot), in a process pool when
+    there is more than one worker. At most two jobs per worker are submitted
+    at a time, so that only a bounded number of plots are held in memory"""
+    if workers <= 1 or len(jobs) <= 1:
+        return [render_plot(job) for job in jobs]
+
+    # Finish any queued writes before the workers are forked
+    flush_output()
+    results = [None] * len(jobs)
+
+    def collect(future, i):
+        # Add the measurements of the stages the worker ran to those of this
+        # process
+        results[i], records = future.result()
+        merge_stage_records(records)
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        pending = {}
+        for i, job in enumerate(jobs):
+            # Wait for a job to finish before submitting more than the limit
+            if len(pending) >= 2 * workers:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    collect(future, pending.pop(future))
+            pending[pool.submit(call_with_stage_records, render_plot, job)] = i
+        for future, i in pending.items():
+            collect(future, i)
+
+    # Add the plots saved by the workers to the manifest of any output writer
+    for job, saved in zip(jobs, results):
+        if saved:
+            record_output(png_filepath(job["filepath"]), "plot")
+    return results
+
+
+def render_plot_specs(
+    specs: List[Dict], patterns: List[str] = None, workers: int = 1
+) -> List[Dict]:
+    """Function to render the plots described by specs, or only those whose
+    output filename matches one of the given patterns (e.g. "*_sex_*").
+    Returns the specs which were rendered"""
+    if patterns:
+        specs = [
+            spec
+            for spec in specs
+            if any(
+                fnmatch(os.path.basename(spec["filepath"]), pattern)
+                for pattern in patterns
+            )
+        ]
+    render_plots(specs, workers)
+    return specs
+
+
+def plot_manifest_filepath(homecare_type: str, stage: str) -> str:
+    """Function to return the path of the plot manifest of an analysis stage"""
+    dirs = homecare_type_dir(homecare_type)
+    return f"{dirs['output_dir']}{homecare_type}_plot_manifest_{stage}.json"
+
+
+def write_plot_manifest(homecare_type: str, stage: str, jobs: List[Dict]):
+    """Function to save a manifest of the plots produced by an analysis stage,
+    from which render_plot_manifests can draw them again"""
+    filepath = plot_manifest_filepath(homecare_type, stage)
+    specs = [plot_spec(job) for job in jobs]
+
+    def write():
+        with open(filepath, "w") as f:
+            json.dump(specs, f, indent=2)
+
+    write_output(write, "plot_manifest", filepath)
+
+
+def read_plot_manifest(homecare_type: str, stage: str) -> List[Dict]:
+    """Function to load the plot manifest of an analysis stage"""
+    with open(plot_manifest_filepath(homecare_type, stage)) as f:
+        return json.load(f)
+
+
+def render_plot_manifests(
+    homecare_type: str,
+    stages: List[str] = None,
+    patterns: List[str] = None,
+    workers: int = 1,
+) -> List[Dict]:
+    """Function to render the plots in the manifests of the given analysis
+    stages (by default all stages with a manifest), or only those whose
+    filename matches one of the given patterns. Returns the specs which were
+    rendered"""
+    if stages is None:
+        # Stages are named after the manifests, i.e. <type>_plot_manifest_region.json
+        output_dir = homecare_type_dir(homecare_type)["output_dir"]
+        prefix = f"{homecare_type}_plot_manifest_"
+        stages = [
+            filename[len(prefix) : -len(".json")]
+            for filename in sorted(os.listdir(output_dir))
+            if filename.startswith(prefix) and filename.endswith(".json")
+        ]
+    specs = []
+    for stage_name in stages:
+        specs += read_plot_manifest(homecare_type, stage_name)
+    return render_plot_specs(specs, patterns, workers)
+
+
+def pivot_plot_job(
     homecare_type: str,
     counts_df: pd.DataFrame,
     term: str,
     variable: str,
     variable_title: str,
     pivot_values: str,
-):
-    """Function to create timeseries of code of interest broken down
-    by variable of interest"""
+    table: str = None,
+    resolution: str = default_resolution,
+) -> Dict:
+    """Function to describe the timeseries of code of interest broken down
+    by variable of interest, which counts_df (of periods of the resolution) is
+    saved to table"""
 
     # Pivot based on column of interest
     pivot_df = counts_df.pivot(
@@ -44,21 +255,43 @@ def produce_pivot_plot(
         values=pivot_values,
     )
 
-    # Produce plot
-    plot_title = "Patients with \'" + term + "\' code, grouped by " + variable_title
-    produce_plot(pivot_df, plot_title, x_label="Date", y_label="Percentage")
-
-    # Save plot
     dirs = homecare_type_dir(homecare_type)
-    plt.savefig(
-        dirs["output_dir"]
+    return {
+        "df": pivot_df,
+        "title": "Patients with \'" + term + "\' code, grouped by " + variable_title,
+        "x_label": "Date",
+        "y_label": "Percentage",
+        "table": table,
+        "index": "index_date",
+        "index_freq": resolution,
+        "pivot": {"columns": variable, "values": pivot_values},
+        "series": [str(column) for column in pivot_df.columns],
+        "filepath": dirs["output_dir"]
         + homecare_type
         + "_plot_"
         + term.replace(" ", "_")
         + "_"
         + variable
-        + "_timeseries.png",
-        bbox_inches="tight",
+        + "_timeseries"
+        + resolution_suffix(resolution)
+        + ".png",
+    }
+
+
+def produce_pivot_plot(
+    homecare_type: str,
+    counts_df: pd.DataFrame,
+    term: str,
+    variable: str,
+    variable_title: str,
+    pivot_values: str,
+):
+    """Function to create timeseries of code of interest broken down
+    by variable of interest"""
+    render_plot(
+        pivot_plot_job(
+            homecare_type, counts_df, term, variable, variable_title, pivot_values
+        )
     )
 
 
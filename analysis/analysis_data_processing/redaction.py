@@ -1,134 +1,227 @@
+from typing import List, Tuple, Union
+import numpy as np
 import pandas as pd
-import math
+import sys
+
+if "." not in sys.path:
+    sys.path.insert(0, ".")
+from analysis.analysis_data_processing.instrumentation import instrumented
+
+
+def numeric_values(column: pd.Series) -> np.ndarray:
+    """Function which takes a column of data and returns its numeric values as
+    floats, with NaN in place of anything that is not a number (i.e. strings
+    such as "[REDACTED]", dates and booleans)"""
+    # Numeric columns can be converted in one step
+    is_numeric = pd.api.types.is_numeric_dtype(column)
+    if is_numeric and not pd.api.types.is_bool_dtype(column):
+        return column.to_numpy(dtype=float, na_value=np.nan)
+    # Columns of other types may still hold some numbers (python or numpy)
+    if pd.api.types.is_object_dtype(column):
+        is_number = column.map(
+            lambda value: isinstance(value, (int, float, np.number))
+            and not isinstance(value, (bool, np.bool_))
+        ).to_numpy(dtype=bool)
+        values = np.full(len(column), np.nan)
+        values[is_number] = column[is_number].to_numpy(dtype=float)
+        return values
+    return np.full(len(column), np.nan)
+
+
+def redact_and_round_values(values: np.ndarray):
+    """Function which takes an array of numeric values (of any shape) and returns
+    the values rounded up to nearest 5, along with a mask of the values less than
+    or equal to 5 which are to be redacted"""
+    # Redact values less than or equal to 5
+    mask = values <= 5
+    # Round all other values up to nearest 5
+    rounded = 5 * np.ceil(values / 5)
+    return rounded, mask
+
+
+def redacted_column(
+    column: pd.Series, values: np.ndarray, rounded: np.ndarray, mask: np.ndarray
+) -> pd.Series:
+    """Function which combines the rounded values and redaction mask of a column
+    into the output column, in which redacted values are replaced by "[REDACTED]"
+    and anything that is not a number is left unchanged"""
+    is_number = ~np.isnan(values)
+    # Columns of numbers with nothing redacted stay as integers
+    if is_number.all() and not mask.any():
+        return pd.Series(rounded.astype(np.int64), index=column.index)
+    new_column = column.to_numpy(dtype=object, copy=True)
+    new_column[is_number] = rounded[is_number].astype(np.int64)
+    new_column[mask] = "[REDACTED]"
+    return pd.Series(new_column, index=column.index)
 
 
 def redact_and_round_column(column: pd.Series) -> pd.Series:
     """Function which takes a column of data, redacts any values less than or
     equal to 5 and rounds all other values up to nearest 5"""
-    # New column variable will contain the new values with any necessary
-    # redacting and rounding applied
-    new_column = []
-    # For loop to apply redacting and rounding to all integer or float values
-    # in the column
-    for value in column:
-        if type(value) == int or type(value) == float:
-            # Redact values less than or equal to 5
-            if value <= 5:
-                value = "[REDACTED]"
-            # Round all values greater than 5 up to nearest 5
-            else:
-                value = int(5 * math.ceil(float(value) / 5))
-        # Resulting value is added to the new column
-        new_column.append(value)
-    return new_column
-    
+    values = numeric_values(column)
+    rounded, mask = redact_and_round_values(values)
+    return redacted_column(column, values, rounded, mask)
+
 
+@instrumented
 def redact_and_round_df(df: pd.DataFrame) -> pd.DataFrame:
     """Function to take a dataframe, redact any values less than or equal to 5 and
     round all other values up to nearest 5"""
-    # Apply redacting and rounding to each column of the dataframe
-    for column in df.columns.values:
-        df[column] = redact_and_round_column(df[column])
+    # Extract the numeric values of every column as one two dimensional array
+    values = np.empty((len(df), len(df.columns)))
+    for i, column in enumerate(df.columns.values):
+        values[:, i] = numeric_values(df[column])
+    # Apply redacting and rounding to the whole dataframe at once
+    rounded, mask = redact_and_round_values(values)
+    # Replace each column with its redacted and rounded values
+    for i, column in enumerate(df.columns.values):
+        df[column] = redacted_column(
+            df[column], values[:, i], rounded[:, i], mask[:, i]
+        )
     return df
 
 
+def group_codes(counts_df: pd.DataFrame) -> Tuple[np.ndarray, int]:
+    """Function which numbers the index dates of a dataframe, returning the group
+    number of each row (-1 where the index date is missing) and number of groups"""
+    codes, uniques = pd.factorize(counts_df["index_date"])
+    return codes, len(uniques)
+
+
+def per_row(array: np.ndarray, values: np.ndarray) -> np.ndarray:
+    """Function which reshapes an array of one item per row to combine with the
+    values of one column or of several (a two dimensional array)"""
+    return array.reshape((-1,) + (1,) * (values.ndim - 1))
+
+
+def group_reduce(
+    ufunc: np.ufunc, values: np.ndarray, codes: np.ndarray, n_groups: int, fill
+) -> np.ndarray:
+    """Function which reduces values within each group with a ufunc (i.e. np.add
+    for sums), and returns the result for each row's group. Values may be one
+    column or several (one per column of a two dimensional array), which are
+    all reduced at once. Rows with no group are reduced into an extra group"""
+    groups = np.where(codes >= 0, codes, n_groups)
+    reduced = np.full((n_groups + 1,) + values.shape[1:], fill, dtype=values.dtype)
+    if len(values):
+        # Sort the rows by group and reduce each run of rows of the same group
+        order = np.argsort(groups, kind="stable")
+        sorted_groups = groups[order]
+        starts = np.flatnonzero(np.diff(sorted_groups, prepend=-1))
+        reduced[sorted_groups[starts]] = ufunc.reduceat(values[order], starts, axis=0)
+    return reduced[groups]
+
+
+def group_sums(values: np.ndarray, codes: np.ndarray, n_groups: int) -> np.ndarray:
+    """Function which sums values within each group, ignoring NaN and rows with no
+    group, and returns the sum for each row's group. Values may be one column or
+    several"""
+    return group_reduce(np.add, np.nan_to_num(values), codes, n_groups, 0.0)
+
+
+def first_group_minimum(
+    values: np.ndarray, eligible: np.ndarray, codes: np.ndarray
+) -> np.ndarray:
+    """Function which returns a mask of the smallest eligible value in each group,
+    taking the first row (in order) where several rows share the smallest value.
+    Values may be one column or several"""
+    n_groups = codes.max() + 1 if len(codes) else 0
+    in_group = per_row(codes >= 0, values)
+    # Find the rows holding the smallest eligible value of their group
+    candidates = np.where(eligible, values, np.inf)
+    minimums = group_reduce(np.minimum, candidates, codes, n_groups, np.inf)
+    is_minimum = eligible & in_group & (candidates == minimums)
+    # Of these, take the first row of each group
+    rows = np.broadcast_to(per_row(np.arange(len(values)), values), values.shape)
+    positions = np.where(is_minimum, rows, len(values))
+    firsts = group_reduce(np.minimum, positions, codes, n_groups, len(values))
+    return is_minimum & (positions == firsts)
+
+
+def redact_to_five_mask(values: np.ndarray, codes: np.ndarray, n_groups: int):
+    """Function which returns a mask of the values to be redacted, given the
+    numeric values of a column, or of several columns (NaN if not a number)
+    and the group number of each row. In each group with a total <= 5 all values
+    are redacted, otherwise all values <= 5 are redacted and, if these add up to
+    <= 5, so is the next lowest value"""
+    in_group = per_row(codes >= 0, values)
+    small = values <= 5
+    # Groups whose total is <= 5 are redacted completely
+    redact_all = in_group & (group_sums(values, codes, n_groups) <= 5)
+    # Groups with values <= 5 which add up to <= 5 need a further redaction
+    has_small = group_sums(small.astype(float), codes, n_groups) > 0
+    small_total = group_sums(np.where(small, values, 0), codes, n_groups)
+    needs_next_lowest = in_group & has_small & (small_total <= 5)
+    next_lowest = first_group_minimum(values, values > 5, codes)
+    return redact_all | (in_group & small) | (needs_next_lowest & next_lowest)
+
+
+@instrumented
 def redact_to_five_and_round(
-    counts_df: pd.DataFrame, column_to_redact: str
+    counts_df: pd.DataFrame, column_to_redact: Union[str, List[str]]
 ) -> pd.DataFrame:
     """Function which determines for each index date if any value in a dataframe column
     is <= 5 and if so redacts all values <=5 then continues redacting the next lowest
     value until the redacted values add up to >= 5.
-    All remaining values are then rounded up to nearest 5"""
-    # For each index date
-    for index_date in counts_df.index_date.unique():
-        # Create temporary dataframe of all the rows with that index date
-        temp_df = counts_df[counts_df["index_date"] == index_date]
-        # If sum of values in the column <= 5
-        if pd.to_numeric(temp_df[column_to_redact], errors="coerce").sum() <= 5:
-            # Redact all values in the column
-            temp_df[column_to_redact] = "[REDACTED]"
-        # Else if there are any numbers <= 5 in the column of interest
-        elif (
-            pd.to_numeric(
-                temp_df[column_to_redact][
-                    pd.to_numeric(temp_df[column_to_redact], errors="coerce") <= 5
-                ],
-                errors="coerce",
-            ).count()
-            > 0
-        ):
-            # Store total quantity redacted
-            total_redacted = 0
-            # For each row
-            for index in temp_df.index.values:
-                # If column value is less than 5
-                if (
-                    pd.to_numeric(temp_df.loc[index, column_to_redact], errors="coerce")
-                    <= 5
-                ):
-                    # Add to the total_redacted variable
-                    total_redacted += temp_df.loc[index, column_to_redact]
-                    # Redact the value
-                    temp_df.loc[index, column_to_redact] = "[REDACTED]"
-                    # While total_redacted <= 5
-                    while total_redacted <= 5:
-                        # Find index of the lowest non-redacted count for that index date
-                        min_index = pd.to_numeric(
-                            temp_df[temp_df[column_to_redact] != "[REDACTED]"][
-                                column_to_redact
-                            ]
-                        ).idxmin()
-                        # Add to the total_redacted variable
-                        total_redacted += temp_df.loc[min_index, column_to_redact]
-                        # Redact the value
-                        temp_df.at[min_index, column_to_redact] = "[REDACTED]"
-        # Update counts dataframe with the redactions
-        counts_df.update(temp_df)
-    # Round all numeric values in column up to nearest 5
-    for index in counts_df.index.values:
-        value = counts_df.loc[index, column_to_redact]
-        if type(value) != str:
-            counts_df.loc[index, column_to_redact] = int(
-                5 * math.ceil(float(value) / 5)
-            )
+    All remaining values are then rounded up to nearest 5.
+    Several columns may be given, which are redacted separately but in one pass"""
+    if isinstance(column_to_redact, str):
+        column_to_redact = [column_to_redact]
+    # Number the index dates once for all columns
+    codes, n_groups = group_codes(counts_df)
+    # Extract the numeric values of every column as one two dimensional array
+    values = np.empty((len(counts_df), len(column_to_redact)))
+    for i, column in enumerate(column_to_redact):
+        values[:, i] = numeric_values(counts_df[column])
+    # Find the values to redact in every index date and column at once
+    mask = redact_to_five_mask(values, codes, n_groups)
+    # Round all other numeric values up to nearest 5
+    rounded, _ = redact_and_round_values(values)
+    for i, column in enumerate(column_to_redact):
+        counts_df[column] = redacted_column(
+            counts_df[column], values[:, i], rounded[:, i], mask[:, i]
+        )
     return counts_df
 
 
-def further_redaction_all(counts_df: pd.DataFrame, column_name: str) -> pd.DataFrame:
+def further_redaction_all(
+    counts_df: pd.DataFrame, column_name: Union[str, List[str]]
+) -> pd.DataFrame:
     """Function which takes a dataframe countaining a column of counts and
     redacts all counts for an index date if any one of the counts for that
-    date is already redacted"""
-    # For  each row of the dataframe
-    for index, row in counts_df.iterrows():
-        # If count redacted
-        if row[column_name] == "[REDACTED]":
-            # Find  its index date
-            removal_index = row["index_date"]
-            # Redact counts for all rows with that index date
-            counts_df.loc[
-                counts_df["index_date"] == removal_index, column_name
-            ] = "[REDACTED]"
+    date is already redacted. Several columns may be given, each of which is
+    redacted separately"""
+    if isinstance(column_name, str):
+        column_name = [column_name]
+    # Number the index dates once for all columns
+    codes, n_groups = group_codes(counts_df)
+    for column in column_name:
+        # Find the index dates with any redacted count
+        is_redacted = (counts_df[column] == "[REDACTED]").to_numpy()
+        any_redacted = group_sums(is_redacted.astype(float), codes, n_groups) > 0
+        # Redact counts for all rows with those index dates
+        counts_df.loc[any_redacted & (codes >= 0), column] = "[REDACTED]"
     return counts_df
 
 
-def further_redaction(counts_df: pd.DataFrame, column_name: str) -> pd.DataFrame:
+def further_redaction(
+    counts_df: pd.DataFrame, column_name: Union[str, List[str]]
+) -> pd.DataFrame:
     """Function which takes a dataframe and redacts smallest remaining value
     in a column for each index date, if one value in that column is already
-    redacted for that index date"""
-    # For each index date
-    for index_date in counts_df.index_date.unique():
-        # Create temporary dataframe of all the rows with that index date
-        temp_df = counts_df[counts_df["index_date"] == index_date]
-        # Count how many are redacted
-        number_of_redactions = temp_df[column_name].to_list().count("[REDACTED]")
-        # If one count is redacted
-        if number_of_redactions == 1:
-            # Find index of the lowest non-redacted count for that index date
-            min_index = pd.to_numeric(
-                temp_df[temp_df[column_name] != "[REDACTED]"][column_name]
-            ).idxmin()
-            # Redact it
-            temp_df.at[min_index, column_name] = "[REDACTED]"
-            # Update counts dataframe with extra redaction
-            counts_df.update(temp_df)
+    redacted for that index date. Several columns may be given, each of which
+    is redacted separately"""
+    if isinstance(column_name, str):
+        column_name = [column_name]
+    # Number the index dates once for all columns
+    codes, n_groups = group_codes(counts_df)
+    for column in column_name:
+        # Count how many are redacted for each index date
+        is_redacted = (counts_df[column] == "[REDACTED]").to_numpy()
+        number_of_redactions = group_sums(is_redacted.astype(float), codes, n_groups)
+        # Find the lowest non-redacted count for each index date
+        values = numeric_values(counts_df[column])
+        lowest = first_group_minimum(values, ~np.isnan(values), codes)
+        # Redact it where one count is redacted
+        counts_df.loc[lowest & (number_of_redactions == 1), column] = "[REDACTED]"
     return counts_df
@@ -0,0 +1,53 @@
+from typing import List
+import os
+import pandas as pd
+
+# The weekly files are the base resolution of every analysis: totals and sets
+# of patients are aggregated once for each week, and then rolled up to periods
+# of the resolution of a run (any pandas period frequency, i.e. "W", "M", "Q"
+# or "Q-MAR" for quarters of financial years). Totals roll up by summing, and
+# sets of patients by their union, collecting the patients of every week of a
+# period into one patient bitmap (see patient_sets.py and breakdown_cube)
+
+# Names of the common resolutions, used in output filenames
+resolution_names = {"W": "weekly", "M": "monthly", "Q": "quarterly"}
+
+# Resolution of the original (monthly) outputs, whose filenames are unchanged
+default_resolution = "M"
+
+
+def analysis_resolution() -> str:
+    """Function to return the resolution analyses are run at, which is set
+    with the ANALYSIS_RESOLUTION environment variable (default "M")"""
+    resolution = os.environ.get("ANALYSIS_RESOLUTION", default_resolution)
+    # Raise an error for anything that is not a period frequency
+    pd.Period("2020-01-01", freq=resolution)
+    return resolution
+
+
+def resolution_suffix(resolution: str) -> str:
+    """Function to return the suffix of output filenames and plot manifest
+    stages at a resolution, which is empty for the default resolution so that
+    monthly outputs keep their names"""
+    if resolution == default_resolution:
+        return ""
+    name = resolution_names.get(resolution, resolution.lower().replace("-", "_"))
+    return f"_{name}"
+
+
+def period_index(index_date: pd.Series, resolution: str) -> pd.Series:
+    """Function to return the period of a resolution which each index date
+    falls in"""
+    return index_date.dt.to_period(resolution)
+
+
+def roll_up(
+    df: pd.DataFrame, resolution: str, columns: List[str], by: List[str] = None
+) -> pd.DataFrame:
+    """Function to roll up totals (i.e. the weekly totals of each code) to
+    periods of a resolution, summing the columns within each period (and group
+    of the columns in by, if any). Rows are in order of period then group, and
+    index_date is the period"""
+    by = by or []
+    keys = [period_index(df["index_date"], resolution)] + [df[key] for key in by]
+    return df.groupby(keys, observed=True)[columns].sum().reset_index()
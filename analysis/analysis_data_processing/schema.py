@@ -0,0 +1,248 @@
+from typing import Dict, List
+import pandas as pd
+
+# Data types of the columns in the weekly input csv files, as produced by the
+# study definitions, common_variables.py and the join to the static cohort
+population_schema = {
+    "patient_id": "int32",
+    "sex": pd.CategoricalDtype(["F", "I", "M", "U"]),
+    "age": "int16",
+    "shielding": "int8",
+    "care_home": "int8",
+    "imd_quintile": "int8",
+    "region": "category",
+    "has_hypertension_code": "int8",
+    "has_diabetes_type_2_code": "int8",
+    "has_asthma_code": "int8",
+    "has_copd_code": "int8",
+    "has_atrial_fibrillation_code": "int8",
+    "ethnicity": pd.CategoricalDtype(["1", "2", "3", "4", "5", "Missing"]),
+}
+
+# Data types of the columns created by looping over codes, keyed by the prefix
+# of the column name (see loop_over_codes in data_processing.py)
+population_schema_prefixes = {
+    "healthcare_at_home_": "int32",
+    "cholesterol_": "float32",
+}
+
+# Flags of whether a patient has a code on or before the index date, keyed by
+# the column of the date of their first such code. The dates are extracted once
+# in study_definition_static.py and the flags are derived when loading
+population_flag_dates = {
+    "shielding_date": "shielding",
+    "care_home_date": "care_home",
+    "hypertension_code_date": "has_hypertension_code",
+    "diabetes_type_2_code_date": "has_diabetes_type_2_code",
+    "asthma_code_date": "has_asthma_code",
+    "copd_code_date": "has_copd_code",
+    "atrial_fibrillation_code_date": "has_atrial_fibrillation_code",
+}
+
+
+def population_dtypes(columns: List[str]) -> Dict:
+    """Function to return the data type to read each of the given input file
+    columns which appears in the population schema as. Columns with declared
+    categories are read with the categories found in the file, which
+    apply_population_categories then checks against the declared ones"""
+    dtypes = {}
+    for column in columns:
+        if column in population_schema:
+            dtype = population_schema[column]
+            if isinstance(dtype, pd.CategoricalDtype):
+                dtype = "category"
+            dtypes[column] = dtype
+        else:
+            for prefix, dtype in population_schema_prefixes.items():
+                if column.startswith(prefix):
+                    dtypes[column] = dtype
+    return dtypes
+
+
+def apply_population_categories(df: pd.DataFrame) -> pd.DataFrame:
+    """Function to give the columns of a weekly dataframe with declared
+    categories those categories, raising an error if a column has any other
+    value (which would otherwise silently become missing)"""
+    for column, dtype in population_schema.items():
+        if column in df.columns and isinstance(dtype, pd.CategoricalDtype):
+            values = df[column]
+            if isinstance(values.dtype, pd.CategoricalDtype):
+                found = values.cat.remove_unused_categories().cat.categories
+            else:
+                found = values.dropna().unique()
+            unexpected = set(found) - set(dtype.categories)
+            if unexpected:
+                raise ValueError(
+                    f"Unexpected values of {column}: {sorted(unexpected, key=str)}"
+                )
+            df[column] = df[column].astype(dtype)
+    return df
+
+
+def population_source_columns(columns: List[str]) -> List[str]:
+    """Function to add to the given columns the first-match date columns of any
+    flags among them, which the flags are derived from"""
+    return columns + [
+        date_column
+        for date_column, flag in population_flag_dates.items()
+        if flag in columns
+    ]
+
+
+def derive_population_flags(
+    df: pd.DataFrame, index_date: pd.Timestamp
+) -> pd.DataFrame:
+    """Function to replace the first-match date columns of a weekly dataframe
+    with the flags derived from them, i.e. whether the date is on or before the
+    index date (patients without a date have a flag of 0)"""
+    for date_column, flag in population_flag_dates.items():
+        if date_column in df.columns:
+            dates = pd.to_datetime(df[date_column], format="%Y-%m-%d")
+            df.insert(
+                df.columns.get_loc(date_column),
+                flag,
+                (dates <= index_date).astype(population_schema[flag]),
+            )
+            df = df.drop(columns=date_column)
+    return df
+
+
+def concat_population(dfs: List[pd.DataFrame]) -> pd.DataFrame:
+    """Function to concatenate weekly dataframes whilst keeping categorical
+    columns categorical, by giving every week the same (sorted) categories"""
+    categorical_columns = [
+        column
+        for column, dtype in dfs[0].dtypes.items()
+        if isinstance(dtype, pd.CategoricalDtype)
+    ]
+    for column in categorical_columns:
+        categories = sorted(
+            set().union(*[df[column].cat.categories for df in dfs]), key=str
+        )
+        for df in dfs:
+            df[column] = df[column].cat.set_categories(categories)
+    return pd.concat(dfs)
+
+
+# Variables which analyses are broken down by, in the order of their outputs.
+# Each is derived from a source column, either by giving its values labels
+# (values without a label keep their value, and missing values are given the
+# missing label if there is one) or by banding it, and has a title for plots.
+# Labels for ethnicity groupings are as stated in "About" section of codelist
+# https://www.opencodelists.org/codelist/opensafely/ethnicity-snomed-0removed/2e641f61/
+breakdown_schema = {
+    "sex": {
+        "source": "sex",
+        "labels": {"M": "Male", "F": "Female", "I": "Intersex", "U": "Unknown"},
+        "title": "sex",
+    },
+    "care_home": {
+        "source": "care_home",
+        "labels": {0: "Not a care home resident", 1: "Care home resident"},
+        "title": "care home residency",
+    },
+    "shielding": {
+        "source": "shielding",
+        "labels": {0: "Not Shielding", 1: "Shielding"},
+        "title": "shielding status",
+    },
+    "age_group": {
+        "source": "age",
+        "bands": {
+            "bins": [-float("inf"), 39, 49, 64, float("inf")],
+            "labels": ["Age 0-39", "Age 40-49", "Age 50-64", "Age 65 or over"],
+        },
+        "title": "age",
+    },
+    "ethnicity": {
+        "source": "ethnicity",
+        "labels": {
+            "1": "White",
+            "2": "Mixed",
+            "3": "Asian or Asian British",
+            "4": "Black or Black British",
+            "5": "Chinese or Other Ethnic Groups",
+        },
+        "missing": "Missing",
+        "title": "ethnicity",
+    },
+    "imd_quintile": {
+        "source": "imd_quintile",
+        "labels": {1: "1", 2: "2", 3: "3", 4: "4", 5: "5"},
+        "title": "IMD quintile (1 = most deprived, 5 = least deprived)",
+    },
+    "has_hypertension_code": {
+        "source": "has_hypertension_code",
+        "labels": {0: "Does not have hypertension", 1: "Has hypertension"},
+        "title": "whether patient has hypertension",
+    },
+    "has_diabetes_type_2_code": {
+        "source": "has_diabetes_type_2_code",
+        "labels": {0: "Does not have type 2 diabetes", 1: "Has type 2 diabetes"},
+        "title": "whether patient has type 2 diabetes",
+    },
+    "has_asthma_code": {
+        "source": "has_asthma_code",
+        "labels": {0: "Does not have asthma", 1: "Has asthma"},
+        "title": "whether patient has asthma",
+    },
+    "has_copd_code": {
+        "source": "has_copd_code",
+        "labels": {0: "Does not have COPD", 1: "Has COPD"},
+        "title": "whether patient has COPD",
+    },
+    "has_atrial_fibrillation_code": {
+        "source": "has_atrial_fibrillation_code",
+        "labels": {
+            0: "Does not have atrial fibrillation",
+            1: "Has atrial fibrillation",
+        },
+        "title": "whether patient has atrial fibrillation",
+    },
+}
+
+
+def breakdown_column(population_df: pd.DataFrame, variable: str) -> pd.Series:
+    """Function to derive a breakdown variable from its source column as
+    declared in the breakdown schema, as a categorical of its labels in
+    alphabetical order"""
+    spec = breakdown_schema[variable]
+    source = population_df[spec["source"]]
+
+    if "bands" in spec:
+        column = pd.cut(
+            source, bins=spec["bands"]["bins"], labels=spec["bands"]["labels"]
+        ).cat.as_unordered()
+    else:
+        column = source.astype("category")
+        # Label missing values
+        if "missing" in spec:
+            if spec["missing"] not in column.cat.categories:
+                column = column.cat.add_categories([spec["missing"]])
+            column = column.fillna(spec["missing"])
+        # Label the categories rather than each value
+        column = column.cat.rename_categories(
+            lambda category: spec["labels"].get(category, category)
+        )
+
+    # Order the labels alphabetically, as a groupby on them would be
+    return column.cat.reorder_categories(sorted(column.cat.categories, key=str))
+
+
+def apply_breakdown_schema(
+    population_df: pd.DataFrame, variables: List[str] = None
+) -> pd.DataFrame:
+    """Function to add the given breakdown variables (by default all of them)
+    to the dataframe, replacing any source column of the same name"""
+    if variables is None:
+        variables = list(breakdown_schema)
+    for variable in variables:
+        population_df[variable] = breakdown_column(population_df, variable)
+    return population_df
+
+
+# Titles of the geographies which regional analyses can be split by, keyed by
+# the column of the area of each patient (others are titled by their column)
+geography_titles = {
+    "region": "Region",
+}
@@ -0,0 +1,14 @@
+# Script to create all analysis outputs (timeseries, regional timeseries,
+# breakdowns and code tables) of oximetry codes, loading the cohorts once
+
+import sys
+
+if "." not in sys.path:
+    sys.path.insert(0, ".")
+from analysis.analysis_data_processing.analysis_all import analysis_all
+
+
+homecare_type = "oximetry"
+codes_of_interest = ["1325191000000108", "1325221000000101", "1325241000000108"]
+
+analysis_all(homecare_type, codes_of_interest, incremental=True)
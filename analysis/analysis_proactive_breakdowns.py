@@ -6,10 +6,10 @@ import sys
 if "." not in sys.path:
     sys.path.insert(0, ".")
 from analysis.analysis_data_processing.analysis_breakdowns import analysis_breakdowns
-from analysis.codelist import proactive_codes
+from analysis.codelist import codelist_codes
 
 
 homecare_type = "proactive"
-codes_of_interest = proactive_codes
+codes_of_interest = codelist_codes("proactive_codes")
 
 analysis_breakdowns(homecare_type, codes_of_interest)
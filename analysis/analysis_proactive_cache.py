@@ -0,0 +1,16 @@
+# Script to build the columnar cache and partial aggregates of the weekly
+# proactive care cohorts
+
+import sys
+
+if "." not in sys.path:
+    sys.path.insert(0, ".")
+from analysis.analysis_data_processing.aggregates import update_weekly_aggregates
+from analysis.analysis_data_processing.analysis_data_processing import (
+    build_population_cache,
+)
+
+homecare_type = "proactive"
+
+build_population_cache(homecare_type)
+update_weekly_aggregates(homecare_type)
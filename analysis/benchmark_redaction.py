@@ -0,0 +1,245 @@
+# Script to benchmark the redaction functions and check that they redact exactly
+# the same cells as the reference (loop based) implementations, on generated
+# tables of counts. Where the reference fails (when there is no value left to
+# redact) the table is checked index date by index date, and the index dates on
+# which it fails must be left as they were. Exits with an error if any generated
+# table is redacted differently or a redaction function raises an error.
+#
+# python analysis/benchmark_redaction.py [--trials N] [--seed S] [--sizes ...]
+
+import argparse
+import sys
+import time
+import warnings
+from typing import Callable, Dict, List, Tuple
+
+import numpy as np
+import pandas as pd
+
+if "." not in sys.path:
+    sys.path.insert(0, ".")
+from analysis.analysis_data_processing import redaction, redaction_reference
+
+def generate_counts_df(
+    rng: np.random.Generator,
+    n_dates: int,
+    n_categories: int,
+    n_columns: int = 1,
+    max_count: int = 40,
+    missing_rate: float = 0.1,
+) -> pd.DataFrame:
+    """Function to generate a table of counts for each index date and category,
+    with some date-category combinations missing and many small counts"""
+    dates = pd.period_range("2019-04", periods=n_dates, freq="M")
+    # Create all date-category combinations and drop some of them
+    counts_df = pd.DataFrame(
+        {
+            "index_date": np.repeat(dates, n_categories),
+            "category": np.tile(np.arange(n_categories), n_dates),
+        }
+    )
+    counts_df = counts_df[rng.random(len(counts_df)) >= missing_rate]
+    counts_df = counts_df.reset_index(drop=True)
+    # Mix small counts (which need redacting) with larger ones
+    for i in range(n_columns):
+        small = rng.random(len(counts_df)) < 0.3
+        counts_df[f"counts_{i}"] = np.where(
+            small,
+            rng.integers(0, 6, len(counts_df)),
+            rng.integers(0, max_count, len(counts_df)),
+        )
+    return counts_df
+
+
+def count_columns(counts_df: pd.DataFrame) -> List[str]:
+    """Function to return the names of the count columns of a generated table"""
+    return [column for column in counts_df.columns if column.startswith("counts_")]
+
+
+def partly_redacted(counts_df: pd.DataFrame, rng: np.random.Generator) -> pd.DataFrame:
+    """Function to redact some of the counts of a generated table, as the input
+    to further_redaction and further_redaction_all"""
+    counts_df = counts_df.copy()
+    for column in count_columns(counts_df):
+        counts_df[column] = counts_df[column].astype(object)
+        counts_df.loc[rng.random(len(counts_df)) < 0.1, column] = "[REDACTED]"
+    return counts_df
+
+
+def run_function(
+    module, function: str, counts_df: pd.DataFrame, columns: List[str]
+) -> pd.DataFrame:
+    """Function to apply one of the redaction functions to a copy of a table,
+    column by column for the reference functions which take a column name (the
+    redaction functions take all the columns at once)"""
+    df = counts_df.copy()
+    if function == "redact_and_round_df":
+        return getattr(module, function)(df[columns])
+    if module is redaction:
+        return getattr(module, function)(df, columns)
+    for column in columns:
+        df = getattr(module, function)(df, column)
+    return df
+
+
+def cell_values(df: pd.DataFrame, columns: List[str]) -> List:
+    """Function to return the cells of the given columns, with numbers as floats
+    so that 10 and 10.0 compare equal"""
+    return [
+        value if value == "[REDACTED]" else float(value)
+        for column in columns
+        for value in df[column]
+    ]
+
+
+def reference_by_index_date(
+    function: str, counts_df: pd.DataFrame, columns: List[str]
+) -> Tuple[pd.DataFrame, int]:
+    """Function to apply a reference function to each index date and column of
+    a table separately, for tables on which it fails as a whole. The reference
+    fails where there is no value left to redact, so the cells of those index
+    dates are expected to be left as they were. Returns the expected table and
+    the number of index dates (and columns) on which the reference failed"""
+    expected = counts_df.copy()
+    expected[columns] = expected[columns].astype(object)
+    failed = 0
+    for index_date in counts_df["index_date"].unique():
+        rows = counts_df["index_date"] == index_date
+        for column in columns:
+            try:
+                result = run_function(
+                    redaction_reference, function, counts_df[rows], [column]
+                )
+            except ValueError:
+                failed += 1
+                continue
+            expected.loc[rows, column] = result[column]
+    return expected, failed
+
+
+def check_equivalence(trials: int, seed: int) -> Tuple[int, int]:
+    """Function to compare each redaction function with its reference on random
+    tables, returning the number of tables which were redacted differently and
+    the number on which the reference failed (which are compared index date by
+    index date, see reference_by_index_date)"""
+    rng = np.random.default_rng(seed)
+    failures = 0
+    reference_failures = 0
+    for trial in range(trials):
+        # Small tables with small counts give the most edge cases (ties, zeros
+        # and dates whose total is <= 5)
+        counts_df = generate_counts_df(
+            rng,
+            n_dates=int(rng.integers(1, 6)),
+            n_categories=int(rng.integers(2, 8)),
+            n_columns=int(rng.integers(1, 3)),
+            max_count=int(rng.choice([6, 10, 20, 60])),
+            missing_rate=float(rng.choice([0, 0.2])),
+        )
+        # Shuffle some tables so that rows are not in index date order
+        if rng.random() < 0.3:
+            counts_df = counts_df.sample(frac=1, random_state=trial)
+        columns = count_columns(counts_df)
+        inputs = {
+            "redact_and_round_df": counts_df,
+            "redact_to_five_and_round": counts_df,
+            "further_redaction": partly_redacted(counts_df, rng),
+            "further_redaction_all": partly_redacted(counts_df, rng),
+        }
+        for function, df in inputs.items():
+            try:
+                expected = run_function(redaction_reference, function, df, columns)
+            except ValueError:
+                # The reference fails when there is no value left to redact
+                expected, failed = reference_by_index_date(function, df, columns)
+                reference_failures += 1
+                print(
+                    f"{function} reference failed on {failed} index dates"
+                    f" (trial {trial}), which should be left as they were"
+                )
+            try:
+                result = run_function(redaction, function, df, columns)
+            except Exception as error:
+                failures += 1
+                print(f"{function} raised {error!r} (trial {trial})")
+                continue
+            if cell_values(result, columns) != cell_values(expected, columns):
+                failures += 1
+                print(f"{function} differs from the reference (trial {trial}):")
+                print(
+                    df.assign(expected=expected[columns[0]], result=result[columns[0]])
+                )
+    return failures, reference_failures
+
+
+def time_function(function: Callable, repeat: int = 3) -> float:
+    """Function to return the fastest of several timings of a function"""
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def benchmark(sizes: List[int], reference_limit: int, seed: int) -> List[Dict]:
+    """Function to time the redaction functions (and, for tables of up to
+    reference_limit cells, their references) on tables of the given sizes"""
+    rng = np.random.default_rng(seed)
+    results = []
+    for size in sizes:
+        # Tables have 4 count columns and 12 categories for each index date
+        n_dates = max(1, size // (4 * 12))
+        counts_df = generate_counts_df(rng, n_dates, 12, n_columns=4)
+        columns = count_columns(counts_df)
+        inputs = {
+            "redact_and_round_df": counts_df,
+            "redact_to_five_and_round": counts_df,
+            "further_redaction": partly_redacted(counts_df, rng),
+            "further_redaction_all": partly_redacted(counts_df, rng),
+        }
+        cells = len(counts_df) * len(columns)
+        for function, df in inputs.items():
+            result = {"function": function, "cells": cells}
+            result["seconds"] = time_function(
+                lambda: run_function(redaction, function, df, columns)
+            )
+            if cells <= reference_limit:
+                result["reference_seconds"] = time_function(
+                    lambda: run_function(redaction_reference, function, df, columns),
+                    repeat=1,
+                )
+            results.append(result)
+            print(
+                f"{function:<26} {cells:>8} cells  {result['seconds']:.4f}s"
+                + (
+                    f"  (reference {result['reference_seconds']:.4f}s)"
+                    if "reference_seconds" in result
+                    else ""
+                )
+            )
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark the redaction functions against their references"
+    )
+    parser.add_argument("--trials", type=int, default=500)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--sizes", type=int, nargs="+", default=[50, 500, 5000, 50000, 250000]
+    )
+    parser.add_argument("--reference-limit", type=int, default=5000)
+    args = parser.parse_args()
+
+    # The reference implementations assign to copies of dataframes
+    warnings.simplefilter("ignore")
+
+    benchmark(args.sizes, args.reference_limit, args.seed)
+    failures, reference_failures = check_equivalence(args.trials, args.seed)
+    print(
+        f"{args.trials} random tables checked, {failures} redacted differently"
+        f" ({reference_failures} checked by index date, as the reference failed)"
+    )
+    sys.exit(1 if failures else 0)
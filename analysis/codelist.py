@@ -1,21 +1,25 @@
-from cohortextractor import codelist_from_csv, codelist
+# Codelists and codes dictionaries, loaded lazily by name on first use (i.e.
+# `from codelist import bp_codes`), so that importing this module neither imports
+# cohortextractor nor parses any csv file. The parsed codes of the csv files are
+# kept in an on-disk cache (analysis/codelist_cache.json), checked against the
+# checksum of each csv file, which can be rebuilt with:
+#
+# python analysis/codelist.py
 
-import pandas as pd
+import csv
+import hashlib
+import json
+import os
 import sys
+from typing import Dict, List
 
 if "." not in sys.path:
     sys.path.insert(0, ".")
 
-# Codes dictionaries: Keys are SNOMED codes, values are the terms they refer to
-# Create pulse oximetry dictionary
-oximetry_codes_df = pd.read_csv("codelists/opensafely-pulse-oximetry.csv")
-oximetry_codes_dict = oximetry_codes_df.set_index("code")["term"].to_dict()
-
-# Pulse oximetry codes from OpenCodelists
-pulse_oximetry_codes = codelist_from_csv(
-    "codelists/opensafely-pulse-oximetry.csv", system="snomed", column="code"
-)
+codelist_cache_filepath = "analysis/codelist_cache.json"
+codelist_cache_version = 1
 
+# Codes dictionaries: Keys are SNOMED codes, values are the terms they refer to
 # Blood pressure codes
 bp_codes_dict = {
     413606001: "Average home systolic blood pressure",
@@ -24,72 +28,244 @@ bp_codes_dict = {
     314461008: "Average day interval diastolic blood pressure",
 }
 
-bp_codes = codelist([str(x) for x in list(bp_codes_dict.keys())], system="snomed")
-
 # Proactive care code
 proactive_codes_dict = {934231000000106: "Provision of proactive care"}
-proactive_codes = codelist(
-    [str(x) for x in list(proactive_codes_dict.keys())], system="snomed"
-)
-
-# Shielding list codes from OpenCodelists
-shielding_list = codelist_from_csv(
-    "codelists/primis-covid19-vacc-uptake-shield.csv", system="snomed", column="code"
-)
-
-# Care home list
-care_home_codes = codelist_from_csv(
-    "codelists/opensafely-nhs-england-care-homes-residential-status.csv",
-    system="snomed",
-    column="code",
-)
-
-# Ethnicity
-ethnicity_codelist = codelist_from_csv(
-    "codelists/opensafely-ethnicity-snomed-0removed.csv",
-    system="snomed",
-    column="snomedcode",
-    category_column="Grouping_6",
-)
-
-# Hypertension
-hypertension_codes = codelist_from_csv(
-    "codelists/opensafely-hypertension-snomed.csv",
-    system="snomed",
-    column="id",
-)
-
-# diabetes_type_2
-diabetes_type_2_codes = codelist_from_csv(
-    "codelists/opensafely-type-2-diabetes.csv",
-    system="ctv3",
-    column="CTV3ID",
-)
-
-# # asthma
-asthma_codes = codelist_from_csv(
-    "codelists/opensafely-asthma-diagnosis.csv",
-    system="ctv3",
-    column="CTV3ID",
-)
-
-# COPD
-copd_codes = codelist_from_csv(
-    "codelists/opensafely-current-copd.csv",
-    system="ctv3",
-    column="CTV3ID",
-)
-
-# Atrial fibrillation
-atrial_fibrillation_codes = codelist_from_csv(
-    "codelists/opensafely-atrial-fibrillation-or-flutter.csv",
-    system="ctv3",
-    column="CTV3Code",
-)
-
-# Cholesterol
-cholesterol_codes = codelist_from_csv(
-    "codelists/opensafely-cholesterol-tests-numerical-value.csv",
-    system="snomed",
-    column="code",
-)
+
+# Codes dictionaries read from csv files: the file, and its columns of codes and
+# of the terms they refer to
+csv_codes_dicts = {
+    # Pulse oximetry dictionary
+    "oximetry_codes_dict": {
+        "filepath": "codelists/opensafely-pulse-oximetry.csv",
+        "column": "code",
+        "term_column": "term",
+    },
+}
+
+# Codelists from OpenCodelists: the file, coding system, column of codes and
+# (for categorised codelists) column of categories
+csv_codelists = {
+    # Pulse oximetry codes
+    "pulse_oximetry_codes": {
+        "filepath": "codelists/opensafely-pulse-oximetry.csv",
+        "system": "snomed",
+        "column": "code",
+    },
+    # Shielding list codes
+    "shielding_list": {
+        "filepath": "codelists/primis-covid19-vacc-uptake-shield.csv",
+        "system": "snomed",
+        "column": "code",
+    },
+    # Care home list
+    "care_home_codes": {
+        "filepath": "codelists/opensafely-nhs-england-care-homes-residential-status.csv",
+        "system": "snomed",
+        "column": "code",
+    },
+    # Ethnicity
+    "ethnicity_codelist": {
+        "filepath": "codelists/opensafely-ethnicity-snomed-0removed.csv",
+        "system": "snomed",
+        "column": "snomedcode",
+        "category_column": "Grouping_6",
+    },
+    # Hypertension
+    "hypertension_codes": {
+        "filepath": "codelists/opensafely-hypertension-snomed.csv",
+        "system": "snomed",
+        "column": "id",
+    },
+    # diabetes_type_2
+    "diabetes_type_2_codes": {
+        "filepath": "codelists/opensafely-type-2-diabetes.csv",
+        "system": "ctv3",
+        "column": "CTV3ID",
+    },
+    # asthma
+    "asthma_codes": {
+        "filepath": "codelists/opensafely-asthma-diagnosis.csv",
+        "system": "ctv3",
+        "column": "CTV3ID",
+    },
+    # COPD
+    "copd_codes": {
+        "filepath": "codelists/opensafely-current-copd.csv",
+        "system": "ctv3",
+        "column": "CTV3ID",
+    },
+    # Atrial fibrillation
+    "atrial_fibrillation_codes": {
+        "filepath": "codelists/opensafely-atrial-fibrillation-or-flutter.csv",
+        "system": "ctv3",
+        "column": "CTV3Code",
+    },
+    # Cholesterol
+    "cholesterol_codes": {
+        "filepath": "codelists/opensafely-cholesterol-tests-numerical-value.csv",
+        "system": "snomed",
+        "column": "code",
+    },
+}
+
+# Codelists of the codes of a codes dictionary
+dict_codelists = {
+    "bp_codes": "bp_codes_dict",
+    "proactive_codes": "proactive_codes_dict",
+}
+
+__all__ = [
+    "oximetry_codes_dict",
+    "pulse_oximetry_codes",
+    "bp_codes_dict",
+    "bp_codes",
+    "proactive_codes_dict",
+    "proactive_codes",
+    "shielding_list",
+    "care_home_codes",
+    "ethnicity_codelist",
+    "hypertension_codes",
+    "diabetes_type_2_codes",
+    "asthma_codes",
+    "copd_codes",
+    "atrial_fibrillation_codes",
+    "cholesterol_codes",
+]
+
+
+def file_signature(filepath: str) -> Dict:
+    """Function to return the size and checksum of a csv file, which identify
+    the version of the file its cached codes were parsed from"""
+    with open(filepath, "rb") as f:
+        contents = f.read()
+    return {"size": len(contents), "sha256": hashlib.sha256(contents).hexdigest()}
+
+
+def read_codelist_cache() -> Dict:
+    """Function to read the codelist cache, returning an empty cache if there is
+    none (or it was written by a different version of this module)"""
+    try:
+        with open(codelist_cache_filepath) as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        return {"version": codelist_cache_version, "entries": {}}
+    if cache.get("version") != codelist_cache_version:
+        return {"version": codelist_cache_version, "entries": {}}
+    return cache
+
+
+def write_codelist_cache(entries: Dict):
+    """Function to add entries to the codelist cache. The cache is only an
+    optimisation, so it is not written if its directory is read-only"""
+    cache = read_codelist_cache()
+    cache["entries"].update(entries)
+    try:
+        # Write to a temporary file first, so a cache is never half written
+        temporary_filepath = f"{codelist_cache_filepath}.{os.getpid()}.tmp"
+        with open(temporary_filepath, "w") as f:
+            json.dump(cache, f, indent=1, sort_keys=True)
+        os.replace(temporary_filepath, codelist_cache_filepath)
+    except OSError:
+        pass
+
+
+def parse_csv_codes(
+    filepath: str, column: str, category_column: str = None
+) -> List:
+    """Function to parse the codes of a csv file (with their categories or terms
+    if category_column is given), as cohortextractor's codelist_from_csv does"""
+    codes = []
+    with open(filepath, "r") as f:
+        for row in csv.DictReader(f):
+            # Strip whitespace and ignore blank codes
+            code = row[column].strip()
+            if not code:
+                continue
+            if category_column:
+                codes.append([code, row[category_column].strip()])
+            else:
+                codes.append(code)
+    return codes
+
+
+def cached_csv_codes(name: str) -> List:
+    """Function to return the parsed codes of a codelist or codes dictionary
+    which is read from a csv file, from the cache if the file is unchanged"""
+    if name in csv_codelists:
+        spec = csv_codelists[name]
+        category_column = spec.get("category_column")
+    else:
+        spec = csv_codes_dicts[name]
+        category_column = spec["term_column"]
+    signature = file_signature(spec["filepath"])
+
+    entry = read_codelist_cache()["entries"].get(name)
+    if (
+        entry is not None
+        and entry["filepath"] == spec["filepath"]
+        and entry["signature"] == signature
+    ):
+        return entry["codes"]
+
+    # Parse the csv file and cache its codes
+    codes = parse_csv_codes(spec["filepath"], spec["column"], category_column)
+    write_codelist_cache(
+        {name: {"filepath": spec["filepath"], "signature": signature, "codes": codes}}
+    )
+    return codes
+
+
+def load_codes_dict(name: str) -> Dict:
+    """Function to return a codes dictionary by name"""
+    if name in csv_codes_dicts:
+        # Codes are SNOMED codes, so are integers as in the literal dictionaries
+        return {int(code): term for code, term in cached_csv_codes(name)}
+    return globals()[name]
+
+
+def codelist_codes(name: str) -> List[str]:
+    """Function to return the codes of a codelist by name as a list of strings,
+    without importing cohortextractor"""
+    if name in dict_codelists:
+        return [str(code) for code in load_codes_dict(dict_codelists[name])]
+    codes = cached_csv_codes(name)
+    if csv_codelists[name].get("category_column"):
+        return [code for code, category in codes]
+    return codes
+
+
+def load_codelist(name: str):
+    """Function to create a cohortextractor codelist by name, from its cached
+    codes"""
+    from cohortextractor import codelist
+
+    if name in dict_codelists:
+        return codelist(codelist_codes(name), system="snomed")
+    codes = cached_csv_codes(name)
+    if csv_codelists[name].get("category_column"):
+        codes = [tuple(code) for code in codes]
+    return codelist(codes, system=csv_codelists[name]["system"])
+
+
+def __getattr__(name: str):
+    """Function to load a codelist or codes dictionary on first access of its
+    name, keeping it in the module for later accesses"""
+    if name in csv_codes_dicts:
+        value = load_codes_dict(name)
+    elif name in csv_codelists or name in dict_codelists:
+        value = load_codelist(name)
+    else:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    globals()[name] = value
+    return value
+
+
+def compile_codelist_cache():
+    """Function to (re)build the cache of the codes of every csv file"""
+    for name in list(csv_codes_dicts) + list(csv_codelists):
+        cached_csv_codes(name)
+
+
+if __name__ == "__main__":
+    compile_codelist_cache()
+    print(f"Wrote {codelist_cache_filepath}")
@@ -1,6 +1,6 @@
 from cohortextractor import patients
 
-from codelist import *
+from codelist import cholesterol_codes
 from data_processing import loop_over_codes
 
 common_variables = dict(
@@ -20,22 +20,6 @@ common_variables = dict(
             "incidence": 1,
         },
     ),
-    # shielding
-    shielding=patients.with_these_clinical_events(
-        shielding_list,
-        find_first_match_in_period=True,
-        on_or_before="index_date",
-        returning="binary_flag",
-        return_expectations={"incidence": 0.1},
-    ),
-    # care home
-    care_home=patients.with_these_clinical_events(
-        care_home_codes,
-        find_first_match_in_period=True,
-        on_or_before="index_date",
-        returning="binary_flag",
-        return_expectations={"incidence": 0.25},
-    ),
     # IMD quintile
     imd_quintile=patients.categorised_as(
         {
@@ -86,71 +70,6 @@ common_variables = dict(
             },
         },
     ),
-    # Patient has hypertension
-    has_hypertension_code=patients.with_these_clinical_events(
-        hypertension_codes,
-        on_or_before="index_date",
-        returning ="binary_flag",
-        return_expectations={
-            "date": {
-                "earliest": "2020-01-15",
-                "latest": "2022-02-01",
-            },
-            "incidence": 0.7,
-        },
-    ),
-    # Patient has diabetes type 2
-    has_diabetes_type_2_code=patients.with_these_clinical_events(
-        diabetes_type_2_codes,
-        on_or_before="index_date",
-        returning ="binary_flag",
-        return_expectations={
-            "date": {
-                "earliest": "2020-01-15",
-                "latest": "2022-02-01",
-            },
-            "incidence": 0.7,
-        },
-    ),
-    # Asthma
-    has_asthma_code=patients.with_these_clinical_events(
-        asthma_codes,
-        on_or_before="index_date",
-        returning ="binary_flag",
-        return_expectations={
-            "date": {
-                "earliest": "2020-01-15",
-                "latest": "2022-02-01",
-            },
-            "incidence": 0.7,
-        },
-    ),
-    # COPD
-    has_copd_code=patients.with_these_clinical_events(
-        copd_codes,
-        on_or_before="index_date",
-        returning ="binary_flag",
-        return_expectations={
-            "date": {
-                "earliest": "2020-01-15",
-                "latest": "2022-02-01",
-            },
-            "incidence": 0.7,
-        },
-    ),
-    # atrial-fibrillation
-    has_atrial_fibrillation_code=patients.with_these_clinical_events(
-        atrial_fibrillation_codes,
-        on_or_before="index_date",
-        returning ="binary_flag",
-        return_expectations={
-            "date": {
-                "earliest": "2020-01-15",
-                "latest": "2022-02-01",
-            },
-            "incidence": 0.7,
-        },
-    ),
     # Cholesterol
     **loop_over_codes(cholesterol_codes, "index_date", "cholesterol", returning="numeric_value")
 )
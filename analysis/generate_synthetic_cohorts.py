@@ -0,0 +1,261 @@
+# Script to generate synthetic weekly cohorts for local benchmarking, in place
+# of the joined cohorts (output/<type>/0.2_join_cohorts/input_<type>_<date>.csv)
+# with the same columns as study_definition_<type>.py, common_variables.py and
+# the join to the static cohort. Each week has the given number of patients,
+# drawn from a population of patients whose characteristics stay the same from
+# week to week. The output is the same for the same seed, sizes and chunk size.
+#
+# python analysis/generate_synthetic_cohorts.py oximetry --weeks 166 \
+#     --patients 100000 [--population N] [--seed S] [--output-dir DIR]
+
+import argparse
+import os
+import sys
+from typing import Dict, List
+
+import numpy as np
+import pandas as pd
+
+if "." not in sys.path:
+    sys.path.insert(0, ".")
+from analysis.codelist import (
+    bp_codes_dict,
+    codelist_codes,
+    oximetry_codes_dict,
+    proactive_codes_dict,
+)
+
+homecare_types = ["oximetry", "bp", "proactive"]
+
+# Codes looped over by each study definition, in the order of their columns
+homecare_codes = {
+    "oximetry": list(oximetry_codes_dict),
+    "bp": list(bp_codes_dict),
+    "proactive": list(proactive_codes_dict),
+}
+
+# Distributions of the patient characteristics. Categories follow the return
+# expectations in common_variables.py and study_definition_static.py, and the
+# prevalence of the conditions is roughly that of the adult population
+sex_ratios = {"F": 0.51, "M": 0.4895, "I": 0.0003, "U": 0.0002}
+region_ratios = {
+    "North East": 0.05,
+    "North West": 0.13,
+    "Yorkshire and the Humber": 0.09,
+    "East Midlands": 0.08,
+    "West Midlands": 0.1,
+    "East of England": 0.11,
+    "London": 0.16,
+    "South East": 0.16,
+    "South West": 0.12,
+}
+imd_quintile_ratios = {1: 0.22, 2: 0.21, 3: 0.2, 4: 0.19, 5: 0.18}
+ethnicity_ratios = {
+    "1": 0.72,
+    "2": 0.02,
+    "3": 0.07,
+    "4": 0.03,
+    "5": 0.02,
+    "Missing": 0.12,
+    "": 0.02,
+}
+# Proportions of patients with a first shielding, care home or condition code,
+# whose dates are spread up to the index date of study_definition_static.py
+first_code_prevalence = {
+    "shielding_date": 0.08,
+    "care_home_date": 0.04,
+    "hypertension_code_date": 0.3,
+    "diabetes_type_2_code_date": 0.1,
+    "asthma_code_date": 0.12,
+    "copd_code_date": 0.05,
+    "atrial_fibrillation_code_date": 0.04,
+}
+first_code_dates = ("1980-01-01", "2022-06-05")
+cholesterol_incidence = 0.05
+cholesterol_codes = codelist_codes("cholesterol_codes")
+
+
+def choose(rng: np.random.Generator, ratios: Dict, size: int) -> np.ndarray:
+    """Function to draw categories with the given ratios, as codes (the
+    position of each category in ratios, see category_labels)"""
+    p = np.array(list(ratios.values()), dtype=float)
+    return rng.choice(len(ratios), size=size, p=p / p.sum()).astype(np.int8)
+
+
+def category_labels(ratios: Dict, codes: np.ndarray) -> np.ndarray:
+    """Function to return the categories of codes drawn by choose"""
+    return np.array(list(ratios), dtype=object)[codes]
+
+
+# Columns of the population drawn as category codes, with their ratios
+population_categories = {
+    "sex": sex_ratios,
+    "imd_quintile": imd_quintile_ratios,
+    "region": region_ratios,
+    "ethnicity": ethnicity_ratios,
+}
+
+
+def generate_population(rng: np.random.Generator, size: int) -> pd.DataFrame:
+    """Function to generate the characteristics of each patient of the
+    population, which are the same in every week. To keep the population
+    small, categories are stored as codes (see choose) and dates of first
+    codes as days since the first of first_code_dates (-1 for patients without
+    a code), which generate_week turns into the values of the cohort files"""
+    population = pd.DataFrame(
+        {
+            "patient_id": rng.permutation(np.arange(1, size + 1)).astype(np.int32),
+            "sex": choose(rng, sex_ratios, size),
+            # Home monitoring is mostly of older adults (ages 1 to 120 are
+            # in the study populations)
+            "age": np.clip(rng.normal(58, 19, size).round(), 1, 120).astype(np.int16),
+            "imd_quintile": choose(rng, imd_quintile_ratios, size),
+            "region": choose(rng, region_ratios, size),
+            "ethnicity": choose(rng, ethnicity_ratios, size),
+        }
+    )
+    first_day, last_day = pd.to_datetime(first_code_dates)
+    days = (last_day - first_day).days
+    for column, prevalence in first_code_prevalence.items():
+        offsets = rng.integers(0, days + 1, size).astype(np.int16)
+        population[column] = np.where(rng.random(size) < prevalence, offsets, -1)
+    return population
+
+
+def population_values(week: pd.DataFrame, column: str) -> np.ndarray:
+    """Function to return the values of a column of the given patients of the
+    population as they are in the cohort files: categories in place of codes,
+    and dates of first codes as YYYY-MM-DD (blank for patients without a
+    code)"""
+    values = week[column].to_numpy()
+    if column in population_categories:
+        return category_labels(population_categories[column], values)
+    if column in first_code_prevalence:
+        first_day = np.datetime64(first_code_dates[0], "D")
+        dates = first_day + values.astype("timedelta64[D]")
+        return np.where(values >= 0, dates.astype(str), "")
+    return values
+
+
+def generate_code_counts(
+    rng: np.random.Generator, codes: List[str], size: int
+) -> np.ndarray:
+    """Function to generate the number of times each patient of a weekly cohort
+    received each code. Earlier codes are used more often, and every patient
+    has at least one code (as the study populations require)"""
+    weights = 0.6 ** np.arange(len(codes))
+    has_code = rng.random((size, len(codes))) < 0.5 * weights
+    # Give patients without any code one code, chosen by the same weights
+    no_code = np.flatnonzero(~has_code.any(axis=1))
+    has_code[
+        no_code, rng.choice(len(codes), len(no_code), p=weights / weights.sum())
+    ] = True
+    return has_code * (1 + rng.poisson(0.4, (size, len(codes))))
+
+
+def generate_week(
+    rng: np.random.Generator, week: pd.DataFrame, codes: List[str]
+) -> pd.DataFrame:
+    """Function to generate the rows of the given patients of the population
+    in a weekly cohort, with the columns in the order of the joined cohorts"""
+    patients = len(week)
+    counts = generate_code_counts(rng, codes, patients)
+    columns = {
+        f"healthcare_at_home_{code}": counts[:, i] for i, code in enumerate(codes)
+    }
+    columns.update(
+        {
+            column: population_values(week, column)
+            for column in ["sex", "age", "imd_quintile", "region"]
+        }
+    )
+    # Cholesterol values are 0 where the patient has no test
+    for code in cholesterol_codes:
+        has_test = rng.random(patients) < cholesterol_incidence
+        columns[f"cholesterol_{code}"] = np.where(
+            has_test, np.clip(rng.normal(5.0, 1.1, patients), 1.5, None).round(1), 0.0
+        )
+    columns["patient_id"] = week["patient_id"].to_numpy()
+    # Columns of the static cohort follow the weekly columns
+    for column in ["ethnicity"] + list(first_code_prevalence):
+        columns[column] = population_values(week, column)
+    return pd.DataFrame(columns)
+
+
+def generate_cohorts(
+    homecare_type: str,
+    weeks: int,
+    patients: int,
+    population_size: int,
+    start: str,
+    seed: int,
+    output_dir: str,
+    chunk_size: int = 100000,
+) -> List[str]:
+    """Function to write the weekly cohort files of a homecare type, generating
+    each week in chunks of patients so memory does not grow with the number of
+    patients. Returns the paths of the files"""
+    os.makedirs(output_dir, exist_ok=True)
+    type_number = homecare_types.index(homecare_type)
+    population = generate_population(
+        np.random.default_rng([seed, type_number]), population_size
+    )
+    codes = homecare_codes[homecare_type]
+
+    filepaths = []
+    for week, index_date in enumerate(pd.date_range(start, periods=weeks, freq="7D")):
+        # Each week has its own seed, so any week can be regenerated alone
+        rng = np.random.default_rng([seed, type_number, week])
+        filepath = f"{output_dir}input_{homecare_type}_{index_date:%Y-%m-%d}.csv"
+        # Patients are drawn for the whole week, then written in chunks
+        selected = np.sort(rng.choice(population_size, patients, replace=False))
+        for chunk_start in range(0, patients, chunk_size):
+            chunk = population.iloc[selected[chunk_start : chunk_start + chunk_size]]
+            generate_week(rng, chunk, codes).to_csv(
+                filepath,
+                mode="w" if chunk_start == 0 else "a",
+                header=chunk_start == 0,
+                index=False,
+            )
+        filepaths.append(filepath)
+    return filepaths
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Generate synthetic weekly cohorts for local benchmarking"
+    )
+    parser.add_argument("homecare_types", nargs="+", choices=homecare_types)
+    parser.add_argument("--weeks", type=int, default=166)
+    parser.add_argument("--patients", type=int, default=10000)
+    parser.add_argument(
+        "--population",
+        type=int,
+        help="number of distinct patients (default four times --patients)",
+    )
+    parser.add_argument("--start", default="2019-04-01")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--output-dir",
+        help="directory for the files (default output/<type>/0.2_join_cohorts/)",
+    )
+    parser.add_argument("--chunk-size", type=int, default=100000)
+    args = parser.parse_args()
+
+    population_size = args.population or 4 * args.patients
+    if population_size < args.patients:
+        parser.error("--population must be at least --patients")
+
+    for homecare_type in args.homecare_types:
+        output_dir = args.output_dir or f"output/{homecare_type}/0.2_join_cohorts/"
+        filepaths = generate_cohorts(
+            homecare_type,
+            args.weeks,
+            args.patients,
+            population_size,
+            args.start,
+            args.seed,
+            output_dir,
+            args.chunk_size,
+        )
+        print(f"Wrote {len(filepaths)} weekly {homecare_type} cohorts to {output_dir}")
@@ -0,0 +1,37 @@
+# Script to render the plots described in the plot manifests saved by the
+# analyses of a homecare type, from their saved tables. Renders every plot, or
+# only those of the given stages or whose filename matches a pattern, e.g.
+#
+# python analysis/render_plots.py oximetry --stage breakdowns --select "*_sex_*"
+
+import argparse
+import sys
+
+if "." not in sys.path:
+    sys.path.insert(0, ".")
+from analysis.analysis_data_processing.analysis_data_processing import (
+    analysis_workers,
+)
+from analysis.analysis_data_processing.plot import render_plot_manifests
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Render the plots in the plot manifests of a homecare type"
+    )
+    parser.add_argument("homecare_type", choices=["oximetry", "bp", "proactive"])
+    parser.add_argument(
+        "--stage",
+        dest="stages",
+        action="append",
+        help="timeseries, breakdowns, or the geography of regional plots (region), "
+        "with the suffix of the resolution if not monthly (i.e. timeseries_weekly)",
+    )
+    parser.add_argument("--select", dest="patterns", action="append")
+    parser.add_argument("--workers", type=int, default=analysis_workers())
+    args = parser.parse_args()
+
+    specs = render_plot_manifests(
+        args.homecare_type, args.stages, args.patterns, args.workers
+    )
+    print(f"Rendered {len(specs)} plots")
@@ -2,7 +2,16 @@ from cohortextractor import (
     StudyDefinition,
     patients,
 )
-from codelist import ethnicity_codelist
+from codelist import (
+    asthma_codes,
+    atrial_fibrillation_codes,
+    care_home_codes,
+    copd_codes,
+    diabetes_type_2_codes,
+    ethnicity_codelist,
+    hypertension_codes,
+    shielding_list,
+)
 
 study = StudyDefinition(
     default_expectations={
@@ -12,6 +21,103 @@ study = StudyDefinition(
     },
     index_date="2022-06-05",
     population=patients.all(),
+    # Dates of the first shielding, care home and condition codes, extracted once
+    # rather than as flags every week: the flags of a weekly cohort (whether the
+    # patient has a code on or before its index date) are derived from these
+    # dates when the weekly files are loaded
+    # shielding
+    shielding_date=patients.with_these_clinical_events(
+        shielding_list,
+        find_first_match_in_period=True,
+        on_or_before="index_date",
+        returning="date",
+        date_format="YYYY-MM-DD",
+        return_expectations={"incidence": 0.1},
+    ),
+    # care home
+    care_home_date=patients.with_these_clinical_events(
+        care_home_codes,
+        find_first_match_in_period=True,
+        on_or_before="index_date",
+        returning="date",
+        date_format="YYYY-MM-DD",
+        return_expectations={"incidence": 0.25},
+    ),
+    # Patient has hypertension
+    hypertension_code_date=patients.with_these_clinical_events(
+        hypertension_codes,
+        find_first_match_in_period=True,
+        on_or_before="index_date",
+        returning="date",
+        date_format="YYYY-MM-DD",
+        return_expectations={
+            "date": {
+                "earliest": "2020-01-15",
+                "latest": "2022-02-01",
+            },
+            "incidence": 0.7,
+        },
+    ),
+    # Patient has diabetes type 2
+    diabetes_type_2_code_date=patients.with_these_clinical_events(
+        diabetes_type_2_codes,
+        find_first_match_in_period=True,
+        on_or_before="index_date",
+        returning="date",
+        date_format="YYYY-MM-DD",
+        return_expectations={
+            "date": {
+                "earliest": "2020-01-15",
+                "latest": "2022-02-01",
+            },
+            "incidence": 0.7,
+        },
+    ),
+    # Asthma
+    asthma_code_date=patients.with_these_clinical_events(
+        asthma_codes,
+        find_first_match_in_period=True,
+        on_or_before="index_date",
+        returning="date",
+        date_format="YYYY-MM-DD",
+        return_expectations={
+            "date": {
+                "earliest": "2020-01-15",
+                "latest": "2022-02-01",
+            },
+            "incidence": 0.7,
+        },
+    ),
+    # COPD
+    copd_code_date=patients.with_these_clinical_events(
+        copd_codes,
+        find_first_match_in_period=True,
+        on_or_before="index_date",
+        returning="date",
+        date_format="YYYY-MM-DD",
+        return_expectations={
+            "date": {
+                "earliest": "2020-01-15",
+                "latest": "2022-02-01",
+            },
+            "incidence": 0.7,
+        },
+    ),
+    # atrial-fibrillation
+    atrial_fibrillation_code_date=patients.with_these_clinical_events(
+        atrial_fibrillation_codes,
+        find_first_match_in_period=True,
+        on_or_before="index_date",
+        returning="date",
+        date_format="YYYY-MM-DD",
+        return_expectations={
+            "date": {
+                "earliest": "2020-01-15",
+                "latest": "2022-02-01",
+            },
+            "incidence": 0.7,
+        },
+    ),
     # Ethnicity
     ethnicity=patients.categorised_as(
         {